@@ -54,7 +54,7 @@ traits_min_version = '3.2.0'
 networkx_min_version = '1.4'
 mayavi_min_version = '3.3.2'
 h5py_min_version = '1.2.0'
-scipy_min_version = '0.5'
+scipy_min_version = '0.11'
 
 
 # for ubuntu 10.04
@@ -71,7 +71,7 @@ python_enthought_traits_ui = '3.1.0' # python-enthought-traits-ui
 enthoughtbase_min_version = '3.0.3' # python-enthoughtbase
 chaco_min_version = '3.2.0' # python-chaco
 lxml_min_version = '2.2.4' # python-lxml
-scipy_min_version = '0.5' # python-scipy (0.7.0)
+scipy_min_version = '0.11' # python-scipy (scipy.sparse.csgraph)
 numpy_min_version = '1.3.0' # python-numpy
 h5py_min_version = '1.2.1' # python-h5py
 mayavi_min_version = '3.3.0' # mayavi2
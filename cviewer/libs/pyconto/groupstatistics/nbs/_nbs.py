@@ -1,5 +1,11 @@
+import os
+import time
+import multiprocessing
+from hashlib import sha1
+
 import numpy as np
-import networkx as netwx
+from scipy import sparse, stats
+from scipy.sparse import csgraph
 
 def ttest2(X,Y):
     """ Compute the two-sided t-statistic of X,Y
@@ -12,7 +18,607 @@ def ttest2(X,Y):
     t = t / (s*np.sqrt(1/n1+1/n2))
     return t
 
-def compute_nbs(X, Y, THRESH, K = 1000, TAIL = 'both'):
+def ttest2_edges(X, Y):
+    """ Compute the two-sided t-statistic of X,Y for all edges at once
+
+    Vectorized version of `ttest2` that treats every row of X and Y
+    as the samples of one edge.
+
+    Parameters
+    ----------
+    X, Y : ndarray
+           (M,nx) and (M,ny) arrays, M edges by the members of each population
+
+    Returns
+    -------
+    t : ndarray
+        (M,) array of t-statistics, equal to `ttest2` applied row by row
+    """
+    # row-wise reductions on contiguous rows sum in the same order as
+    # the one-dimensional reductions in ttest2
+    X = np.ascontiguousarray(X)
+    Y = np.ascontiguousarray(Y)
+    n1 = X.shape[1] * 1.
+    n2 = Y.shape[1] * 1.
+    t = np.mean(X, axis=1) - np.mean(Y, axis=1)
+    s = np.sqrt( ( (n1-1) * np.var(X,axis=1,ddof=1) + (n2-1)*np.var(Y,axis=1,ddof=1) ) / (n1+n2-2.) )
+    t = t / (s*np.sqrt(1/n1+1/n2))
+    return t
+
+def _check_random_state(seed):
+    """ Turn seed into a np.random.RandomState instance """
+    if seed is None:
+        return np.random.mtrand._rand
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+def _pval_decided(hits, k, alpha, confidence):
+    """ Whether the p-values estimated from k permutations are decided
+
+    Every p-value is decided when its Clopper-Pearson confidence interval,
+    computed from its number of hits among k permutations, lies entirely
+    below or above alpha.
+    """
+    a = 1. - confidence
+    lower = np.where(hits > 0, stats.beta.ppf(a / 2, hits, k - hits + 1), 0.)
+    upper = np.where(hits < k, stats.beta.ppf(1 - a / 2, hits + 1, k - hits), 1.)
+    return np.all( (upper < alpha) | (lower > alpha) )
+
+def _edge_components(edges):
+    """ Connected components of the graph given by a list of edges
+
+    Only the nodes touched by an edge are considered, such that neither
+    a dense adjacency matrix nor a graph over all nodes is created.
+
+    Parameters
+    ----------
+    edges : ndarray
+        (E,2) array of node index pairs
+
+    Returns
+    -------
+    comp : ndarray
+        (E,) array of the component index of each edge. Components are
+        numbered by their smallest node index.
+    sizes : ndarray
+        (C,) array of the number of edges of each component
+    """
+    if len(edges) == 0:
+        return np.zeros(0, dtype = np.int32), np.zeros(0)
+
+    # relabel the touched nodes to 0..n-1
+    nodes, inv = np.unique(edges, return_inverse = True)
+    inv = inv.reshape(edges.shape)
+    n = len(nodes)
+
+    G = sparse.coo_matrix( (np.ones(len(inv)), (inv[:,0], inv[:,1])), shape = (n,n) )
+    nr_comp, labels = csgraph.connected_components(G, directed = False)
+
+    comp = labels[inv[:,0]]
+    sizes = np.bincount(comp, minlength = nr_comp).astype(np.float64)
+    return comp, sizes
+
+def _tail(t_stat, TAIL):
+    """ Adapt the t-statistic to the alternative hypothesis of TAIL """
+    if TAIL == 'both' or TAIL == 'equal':
+        return np.abs( t_stat )
+    elif TAIL == 'left':
+        return -t_stat
+    elif TAIL == 'right':
+        return t_stat
+    else:
+        raise ValueError('Tail option not recognized')
+
+def _ind2ij(ind, N):
+    """ Node index pairs of upper triangular edge indices
+
+    Edges are indexed in the row-major order of the upper triangle of
+    an N x N matrix, i.e. in the order of np.triu_indices(N, 1).
+
+    Parameters
+    ----------
+    ind : ndarray
+        (E,) array of edge indices
+    N : integer
+        number of nodes
+
+    Returns
+    -------
+    ij : ndarray
+        (E,2) array of node index pairs
+    """
+    ind = np.asarray(ind, dtype = np.int64)
+    rows = np.arange(N, dtype = np.int64)
+    # index of the first edge of each row
+    rowstart = rows * (2 * N - rows - 1) // 2
+    ij = np.zeros( (len(ind), 2), dtype = np.int64 )
+    ij[:,0] = np.searchsorted(rowstart[:-1], ind, side = 'right') - 1
+    ij[:,1] = ind - rowstart[ij[:,0]] + ij[:,0] + 1
+    return ij
+
+class _TwoSample(object):
+    """ Two-sample t-test of the first nx members against the others """
+
+    def __init__(self, nx):
+        self.nx = nx
+        self.key = np.array([nx], dtype = np.float64)
+
+    def tstats(self, chunk, perms, start = 0):
+        """ t-statistics of a chunk of edges for each permutation """
+        nx = self.nx
+        # assume independent random samples
+        return [ ttest2_edges(chunk[:, indperm[:nx]], chunk[:, indperm[nx:]])
+                 for indperm in perms ]
+
+class _FreedmanLane(object):
+    """ GLM t-statistic of a contrast, permuted with the Freedman-Lane method
+
+    The data is reduced to the residuals R of the nuisance model Z, which
+    consists of the part of the design orthogonal to the contrast. A
+    permutation P yields the data P R + H_z Y, of which the contrast
+    c'b and the residual sum of squares follow from the projection on an
+    orthonormal basis Q of the design. For a block of permutations, this
+    projection is one matrix product of R with the permuted bases.
+    """
+
+    def __init__(self, design, contrast):
+        design = np.asarray(design, dtype = np.float64)
+        contrast = np.asarray(contrast, dtype = np.float64).ravel()
+        n, p = design.shape
+        if len(contrast) != p:
+            raise ValueError('Contrast needs one entry per column of the design')
+        if np.linalg.matrix_rank(design) < p:
+            raise ValueError('Design matrix is rank deficient')
+        if p >= n:
+            raise ValueError('Design matrix needs more rows than columns')
+
+        # orthonormal basis of the design, design = Q Rx, such that
+        # c'b = w'Q'Y and c'(X'X)^-1 c = w'w
+        self.Q, Rx = np.linalg.qr(design)
+        self.w = np.linalg.solve(Rx.T, contrast)
+        self.ww = np.dot(self.w, self.w)
+        self.dof = n - p
+
+        # nuisance regressors, the design without the effect of the contrast
+        Z = design - np.outer(np.dot(design, contrast), contrast) / np.dot(contrast, contrast)
+        # residual forming matrix of the nuisance model, and the fitted
+        # part projected on the design basis, for the data as rows
+        Hz = np.dot( Z, np.linalg.pinv(Z) )
+        self.Rz = np.eye(n) - Hz
+        self.HzQ = np.dot( Hz, self.Q )
+        self.key = np.concatenate( (design.ravel(), contrast) )
+        # the residuals, constants and residual sum of squares of each
+        # chunk by (start, shape), reused by all permutation blocks
+        self._residuals = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_residuals'] = {}
+        return state
+
+    def _residuals_of(self, chunk, start):
+        """ Residuals of the nuisance model, constants and rss of a chunk """
+        key = (start, chunk.shape)
+        if not key in self._residuals:
+            R = np.dot( chunk, self.Rz )
+            self._residuals[key] = ( R, np.dot( chunk, self.HzQ ), np.sum( R**2, axis = 1 ) )
+        return self._residuals[key]
+
+    def tstats(self, chunk, perms, start = 0):
+        """ t-statistics of a chunk of edges for each permutation
+
+        The residuals of the chunk starting at edge start are computed
+        once, a model is only used with one data set. The products take
+        len(chunk) * rank(design) * len(perms) floats.
+        """
+        R, const, rss = self._residuals_of(chunk, start)
+
+        # permuting the rows of R is permuting the rows of Q in Q'R
+        r = self.Q.shape[1]
+        Qperm = np.zeros( (self.Q.shape[0], r * len(perms)) )
+        for k, indperm in enumerate(perms):
+            Qperm[indperm, k*r:(k+1)*r] = self.Q
+        U = np.dot(R, Qperm)
+
+        t = []
+        for k in range(len(perms)):
+            Uk = U[:, k*r:(k+1)*r]
+            sse = np.maximum( rss - np.sum( Uk**2, axis = 1 ), 0 )
+            t.append( np.dot(Uk + const, self.w) / np.sqrt( sse / self.dof * self.ww ) )
+        return t
+
+def _suprathreshold_edges(D, model, THRESH, TAIL, perms, chunk_size = None, times = None):
+    """ Suprathreshold edges for permutations of the members
+
+    D is read in chunks of chunk_size edges, and every chunk is used for
+    all the permutations before the next one is read. Only the indices
+    and t-statistics of the suprathreshold edges are kept.
+
+    Parameters
+    ----------
+    D : ndarray
+        (M,n) array of the vectorized connectivity values of all
+        members, may be a memmap
+    model : _TwoSample or _FreedmanLane
+        the statistical model giving the t-statistics
+    THRESH : float or sequence of floats
+        edges above the lowest threshold are kept
+    TAIL : {'both', 'left', 'right'}
+    perms : list of ndarray
+        permutations of the n members
+    chunk_size : integer, optional
+        number of edges per chunk, all at once if None
+    times : dict, optional
+        the seconds spent reading, testing and thresholding are added
+        to its 'read', 'ttest' and 'threshold' entries
+
+    Returns
+    -------
+    ind : list of ndarray
+        indices of the suprathreshold edges for each permutation
+    tval : list of ndarray
+        t-statistics of these edges, adapted to the tail
+    """
+    M = D.shape[0]
+    if chunk_size is None:
+        chunk_size = max(M, 1)
+    thresh = np.min(THRESH)
+    ind = [ [np.zeros(0, dtype = np.int64)] for indperm in perms ]
+    tval = [ [np.zeros(0)] for indperm in perms ]
+    for start in range(0, M, chunk_size):
+        t0 = time.time()
+        chunk = np.asarray( D[start:start + chunk_size], dtype = np.float64 )
+        t1 = time.time()
+        # Perform T-test at each edge
+        t_stats = model.tstats(chunk, perms, start)
+        t2 = time.time()
+        for k, t_stat in enumerate(t_stats):
+            t_stat = _tail( t_stat, TAIL )
+            # Threshold
+            ind_t = np.nonzero( t_stat > thresh )[0]
+            ind[k].append( start + ind_t )
+            tval[k].append( t_stat[ind_t] )
+        if times is not None:
+            times['read'] += t1 - t0
+            times['ttest'] += t2 - t1
+            times['threshold'] += time.time() - t2
+    return [ np.concatenate(l) for l in ind ], [ np.concatenate(l) for l in tval ]
+
+def _max_component_size(ind, N):
+    """ Size of the largest component of suprathreshold edges
+
+    Parameters
+    ----------
+    ind : ndarray
+        (E,) array of the indices of the suprathreshold edges
+    N : integer
+        number of nodes
+
+    Returns
+    -------
+    max_sz : float
+        number of edges of the largest component, zero if there is none
+    """
+    # Find network components of the suprathreshold edges
+    comp, sz_links = _edge_components( _ind2ij(ind, N) )
+    
+    if len(sz_links) > 0:
+        return np.max(sz_links)
+    else:
+        return 0
+
+def _null_max_sizes(nullargs, seeds):
+    """ Maximal component size for each permutation given by its seed
+
+    Returns a (len(seeds), len(THRESH)) array, one column per threshold,
+    and a dict of the seconds spent in each stage.
+    """
+    D, model, THRESH, TAIL, N, chunk_size = nullargs
+    times = dict.fromkeys( _STAGES, 0.0 )
+    # Randomize
+    perms = [ np.random.RandomState(seed).permutation( D.shape[1] ) for seed in seeds ]
+    ind, tval = _suprathreshold_edges(D, model, THRESH, TAIL, perms, chunk_size, times)
+    t0 = time.time()
+    sz = np.zeros( (len(seeds), len(THRESH)) )
+    for k in range(len(seeds)):
+        for j, thresh in enumerate(THRESH):
+            sz[k,j] = _max_component_size(ind[k][tval[k] > thresh], N)
+    times['components'] += time.time() - t0
+    return sz, times
+
+# stages of a permutation, in the order of the timing report
+_STAGES = ('read', 'ttest', 'threshold', 'components')
+
+# arguments of _null_max_sizes, set in each worker process of the pool
+_worker_nullargs = None
+
+def _init_null_worker(nullargs):
+    global _worker_nullargs
+    _worker_nullargs = nullargs
+
+def _null_worker(seeds):
+    return _null_max_sizes(_worker_nullargs, seeds)
+
+def _null_distribution(nullargs, seeds, n_jobs = 1, block_size = 1, times = None):
+    """ Generate the maximal component size of each permutation, in order
+
+    The permutations are computed in blocks of block_size, which are
+    distributed over a pool of n_jobs processes. Because every permutation
+    is derived from its own seed, the generated values do not depend on
+    the number of processes or the block size. The seconds spent in each
+    stage, summed over the processes, are added to times.
+    """
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count()
+    if times is None:
+        times = dict.fromkeys( _STAGES, 0.0 )
+    blocks = [ seeds[i:i + block_size] for i in range(0, len(seeds), block_size) ]
+    if n_jobs <= 1 or len(blocks) <= 1:
+        for block in blocks:
+            sz, t = _null_max_sizes(nullargs, block)
+            for stage in _STAGES:
+                times[stage] += t[stage]
+            for s in sz:
+                yield s
+        return
+
+    # the workers inherit the data from this process on fork
+    pool = multiprocessing.Pool(n_jobs, _init_null_worker, (nullargs,))
+    try:
+        for sz, t in pool.imap(_null_worker, blocks):
+            for stage in _STAGES:
+                times[stage] += t[stage]
+            for s in sz:
+                yield s
+    finally:
+        pool.terminate()
+
+def _data_digest(nullargs):
+    """ Hash of the data and the model, read in chunks as for the t-tests """
+    D, model, THRESH, TAIL, N, chunk_size = nullargs
+    M = D.shape[0]
+    if chunk_size is None:
+        chunk_size = max(M, 1)
+    h = sha1( np.asarray(model.key, dtype = np.float64).tostring() )
+    for start in range(0, M, chunk_size):
+        h.update( np.ascontiguousarray(D[start:start + chunk_size]).tostring() )
+    return h.hexdigest()
+
+def _replace(src, dst):
+    """ Rename src to dst, replacing dst also on Windows """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def _save_checkpoint(fname, NULL, k, rng_state, nullargs, digest):
+    """ Store the state of a permutation run after k permutations
+
+    digest is the _data_digest of nullargs, which identifies the data.
+    """
+    D, model, THRESH, TAIL, N, chunk_size = nullargs
+    # write to a temporary file first, such that an interruption
+    # never leaves a corrupt checkpoint behind
+    tmpname = fname + '.tmp'
+    f = open(tmpname, 'wb')
+    try:
+        np.savez(f, NULL = NULL[:k], k = k, K = len(NULL),
+                 rng_keys = rng_state[1], rng_pos = rng_state[2],
+                 rng_has_gauss = rng_state[3], rng_cached_gaussian = rng_state[4],
+                 THRESH = THRESH, TAIL = TAIL, model = model.key, shape = D.shape,
+                 digest = digest)
+    finally:
+        f.close()
+    _replace(tmpname, fname)
+
+def _load_checkpoint(fname, K, nullargs, digest):
+    """ Load the state of a permutation run stored by _save_checkpoint
+
+    Returns
+    -------
+    NULL : ndarray
+        the first k rows of the null distribution
+    k : integer
+        number of permutations already computed
+    rng_state : tuple
+        state of the random number generator the seeds are drawn from
+    """
+    D, model, THRESH, TAIL, N, chunk_size = nullargs
+    c = np.load(fname)
+    if c['K'] != K or not np.array_equal(c['model'], model.key) or str(c['TAIL']) != TAIL or \
+        tuple(c['shape']) != tuple(D.shape) or not np.array_equal(c['THRESH'], THRESH):
+        raise ValueError('Checkpoint %s was written for different parameters' % fname)
+    if not 'digest' in c.files or str(c['digest']) != digest:
+        raise ValueError('Checkpoint %s was written for different data' % fname)
+    rng_state = ('MT19937', c['rng_keys'], int(c['rng_pos']),
+                 int(c['rng_has_gauss']), float(c['rng_cached_gaussian']))
+    return c['NULL'], int(c['k']), rng_state
+
+def _permutation_test(nullargs, sz_links, K, n_jobs = 1, random_state = None,
+                      early_stop = False, alpha = 0.05, confidence = 0.99,
+                      checkpoint = None, checkpoint_every = 100, resume_from = None,
+                      block_size = 1, progress = None, timing = None):
+    """ Estimate the null distribution and the p-values of the components
+
+    Parameters are the ones of compute_nbs, sz_links is the list of the
+    sizes of the observed components for each threshold.
+
+    Returns
+    -------
+    PVAL : list of ndarray
+        p-values for each threshold
+    NULL : ndarray
+        (nr_perm, len(sz_links)) array, one column per threshold
+    """
+    max_sz = np.array( [ np.max(sz) if len(sz) > 0 else 0 for sz in sz_links ] )
+
+    print "Max component size is: %s" % _format_sizes(max_sz)
+        
+    # Empirically estimate null distribution of maximum component size by
+    # generating K independent permutations.
+    print "=====================================================" 
+    print "Estimating null distribution with permutation testing"
+    print "====================================================="
+    
+    NULL = np.zeros( (K, len(sz_links)) )
+
+    # identifies the data of a checkpoint
+    digest = None
+    if checkpoint is not None or resume_from is not None:
+        digest = _data_digest(nullargs)
+
+    # draw one seed per permutation up front, such that every permutation
+    # is reproducible independently of the worker which computes it
+    if resume_from is None:
+        rng = _check_random_state(random_state)
+        start = 0
+    else:
+        # continue with the state of the interrupted run
+        NULL_done, start, rng_state = _load_checkpoint(resume_from, K, nullargs, digest)
+        NULL[:start] = NULL_done
+        rng = np.random.RandomState()
+        rng.set_state(rng_state)
+        print "Resuming from %s after %d of %d permutations" % (resume_from, start, K)
+    rng_state = rng.get_state()
+    seeds = rng.randint(0, np.iinfo(np.int32).max, size = K)
+
+    # number of hits for each observed component of all thresholds
+    sz_all = np.concatenate( [ np.zeros(0) ] + list(sz_links) )
+    thresh_all = np.concatenate( [ np.zeros(0, dtype = np.int64) ] +
+                                 [ j * np.ones(len(sz), dtype = np.int64) for j, sz in enumerate(sz_links) ] )
+    hit = np.sum( NULL[:start] >= max_sz, axis = 0 ).astype(np.float64)
+    hits = np.sum( NULL[:start, thresh_all] >= sz_all, axis = 0 ).astype(np.float64)
+    nr_perm = K
+
+    times = dict.fromkeys( _STAGES, 0.0 )
+    tstart = time.time()
+    for k, sz_links_perm_max in enumerate(_null_distribution(nullargs, seeds[start:], n_jobs,
+                                                             block_size, times), start):
+    
+        NULL[k] = sz_links_perm_max
+
+        # if the component size of this random permutation is bigger than
+        # the component size of the group difference computed above, this is a hit
+        hit += NULL[k] >= max_sz
+        hits += NULL[k, thresh_all] >= sz_all
+            
+        if progress is not None:
+            if len(sz_links) == 1:
+                progress(k + 1, K, NULL[k, 0], max_sz[0], hit[0] / (k + 1))
+            else:
+                progress(k + 1, K, NULL[k], max_sz, hit / (k + 1))
+
+        # without observed components there is no p-value to decide, and
+        # all K permutations are generated
+        if early_stop and len(sz_all) > 0 and _pval_decided(hits, k + 1, alpha, confidence):
+            nr_perm = k + 1
+            print "Stopped early after %d of %d permutations" % (nr_perm, K)
+            break
+
+        if checkpoint is not None and (k + 1) % checkpoint_every == 0:
+            _save_checkpoint(checkpoint, NULL, k + 1, rng_state, nullargs, digest)
+
+    NULL = NULL[:nr_perm]
+
+    if timing is not None:
+        timing.update(times)
+        timing['total'] = time.time() - tstart
+        timing['nr_perm'] = nr_perm - start
+        timing['n_jobs'] = multiprocessing.cpu_count() if n_jobs < 0 else max(n_jobs, 1)
+        if timing['total'] > 0:
+            timing['perms_per_second'] = timing['nr_perm'] / timing['total']
+        else:
+            timing['perms_per_second'] = 0.0
+
+    # Calculate p-values for each component
+    PVAL = []
+    for j, sz in enumerate(sz_links):
+        PVAL.append( np.zeros( len(sz) ) )
+        for i in range( len(sz) ):
+            PVAL[j][i] = np.sum( NULL[:,j] >= sz[i] ) * 1.0 / nr_perm
+        
+    return PVAL, NULL
+
+def _format_sizes(sz):
+    return ", ".join( "%d" % s for s in np.atleast_1d(sz) )
+
+def _format_pvals(p):
+    return ", ".join( "%0.3f" % s for s in np.atleast_1d(p) )
+
+def print_progress(every = 100):
+    """ Progress callback printing every `every` permutations
+
+    Pass the result as the progress argument of compute_nbs to get the
+    per-permutation report on stdout, e.g. print_progress(1). The values
+    of all thresholds of compute_nbs_sweep are printed comma-separated.
+    """
+    def progress(k, K, perm_max, observed_max, pval):
+        if k % every == 0 or k == K:
+            print "Perm %d of %d. Perm max is: %s. Observed max is: %s. P-val estimate is: %s" % \
+                (k,K,_format_sizes(perm_max),_format_sizes(observed_max),_format_pvals(pval))
+    return progress
+
+def print_timing(timing):
+    """ Print the timing report filled in by compute_nbs
+
+    The times of the stages are summed over the worker processes, the
+    total is the wall clock time of the permutations.
+    """
+    print "Permutations: %d in %0.2f s with %d job(s), %0.2f per second" % \
+        (timing['nr_perm'], timing['total'], timing['n_jobs'], timing['perms_per_second'])
+    for stage in _STAGES:
+        print "  %-12s %8.2f s" % (stage, timing[stage])
+
+def _observed_components(D, model, THRESH, TAIL, N, chunk_size = None):
+    """ Components of the suprathreshold edges of the observed data
+
+    Returns
+    -------
+    reledg : list of ndarray
+        (E,2) array of the suprathreshold edges for each threshold
+    comp : list of ndarray
+        (E,) array of the component index of each edge for each threshold
+    sz_links : list of ndarray
+        number of edges of each component for each threshold
+    """
+    ind, tval = _suprathreshold_edges(D, model, THRESH, TAIL, [np.arange(D.shape[1])], chunk_size)
+    reledg, comp, sz_links = [], [], []
+    for thresh in THRESH:
+        # Find network components of the suprathreshold edges
+        edges = _ind2ij(ind[0][tval[0] > thresh], N) # relevant edges
+        c, sz = _edge_components(edges)
+        reledg.append(edges)
+        comp.append(c)
+        sz_links.append(sz)
+    return reledg, comp, sz_links
+
+def _component_matrix(reledg, comp, N):
+    """ Suprathreshold adjacency matrix, where the edges of each component
+    are assigned the index of the component (starting at one) """
+    ADJ = np.zeros( (N,N) )
+    ADJ[ reledg[:,0], reledg[:,1] ] = comp + 1
+    ADJ[ reledg[:,1], reledg[:,0] ] = comp + 1
+    return ADJ
+
+def _vectorize(*matrices):
+    """ Stack the upper triangular edges of N x N x n arrays for permutation """
+    # check input matrices
+    N = matrices[0].shape[0]
+    for X in matrices:
+        assert X.ndim == 3
+        assert X.shape[0] == N
+        assert X.shape[1] == N
+
+    # Only consider elements above upper diagonal due to symmetry
+    ind_i, ind_j = np.triu_indices(N, 1)
+    
+    # Vectorize connectivity matrices and stack them for permutation
+    return np.hstack( [ X[ind_i, ind_j, :] for X in matrices ] ).astype(np.float64)
+
+def compute_nbs(X, Y, THRESH, K = 1000, TAIL = 'both', n_jobs = 1, random_state = None,
+                early_stop = False, alpha = 0.05, confidence = 0.99,
+                checkpoint = None, checkpoint_every = 100, resume_from = None,
+                progress = None, timing = None):
     """ Computes the network-based statistic (NBS) as described in [1]. 
     
     Performs the NBS for populations X and Y for a
@@ -45,6 +651,53 @@ def compute_nbs(X, Y, THRESH, K = 1000, TAIL = 'both'):
         'equal' - alternative hypothesis is means are not equal (default)
         'left'  - mean of population X < mean of population Y
         'right' - mean of population X > mean of population Y
+
+    n_jobs : integer, default = 1, optional.
+        Number of worker processes used to compute the permutations.
+        If -1, all CPUs are used. The resulting NULL does not depend
+        on the number of workers.
+
+    random_state : None, integer or RandomState, optional.
+        Seed or random number generator from which the permutations
+        are drawn. If None, the global NumPy random state is used.
+
+    early_stop : boolean, default = False, optional.
+        If True, stop the permutations as soon as the p-value of every
+        component is known to be below or above alpha, with the given
+        confidence. At most K permutations are generated, all of them
+        if the observed data has no suprathreshold component.
+
+    alpha : float, default = 0.05, optional.
+        Significance level used to decide the p-values for early_stop.
+
+    confidence : float, default = 0.99, optional.
+        Confidence level of the (Clopper-Pearson) interval of each
+        p-value used for early_stop.
+
+    checkpoint : string, optional.
+        File name to which the state of the permutations is saved
+        every checkpoint_every permutations.
+
+    checkpoint_every : integer, default = 100, optional.
+
+    resume_from : string, optional.
+        Checkpoint file of an interrupted run with the same data and
+        parameters. The run continues after the stored permutations and
+        yields the same result as an uninterrupted run.
+
+    progress : callable, optional.
+        Called after every permutation as progress(k, K, perm_max,
+        observed_max, pval) with the number k of permutations done, the
+        maximal component size of the permutation and of the observed
+        data, and the current p-value estimate of the latter, as scalars.
+        print_progress(every) returns a callback printing to stdout.
+
+    timing : dict, optional.
+        Filled with the seconds spent reading the data ('read'), in the
+        t-tests ('ttest'), thresholding ('threshold') and the component
+        search ('components'), summed over the worker processes, and the
+        wall clock time ('total'), number ('nr_perm') and rate
+        ('perms_per_second') of the permutations. See print_timing.
             
     Returns
     -------
@@ -60,6 +713,7 @@ def compute_nbs(X, Y, THRESH, K = 1000, TAIL = 'both'):
     NULL : ndarray
         Returns a vector of K samples 
         from the the null distribution of maximal component size. 
+        With early_stop, its length is the number of permutations used.
 
     ALGORITHM DESCRIPTION 
     The NBS is a nonparametric statistical test used to isolate the 
@@ -104,241 +758,305 @@ def compute_nbs(X, Y, THRESH, K = 1000, TAIL = 'both'):
 
     """
 
-    # check input matrices
-    Ix,Jx,nx = X.shape
-    Iy,Jy,ny = Y.shape
-    
-    assert Ix == Iy
-    assert Jx == Jy
-    assert Ix == Jx
-    assert Iy == Jy
-    
-    # number of nodes
-    N = Ix
+    nx = X.shape[2]
+    N = X.shape[0]
+    d_stacked = _vectorize(X, Y)
 
-    # Only consider elements above upper diagonal due to symmetry
-    ind_mask = ( np.triu(np.ones( (N,N) ),1) == 1 )
-    ind_i, ind_j = np.nonzero( np.triu(np.ones( (N,N) ),1) )
-    
-    # Number of edges
-    M = N * (N - 1) / 2
-    
-    # Look up table
-    ind2ij = np.zeros( (M,2) , dtype = np.int16)
-    ind2ij[:,0] = ind_i
-    ind2ij[:,1] = ind_j
-    
-    # Vectorize connectivity matrices
-    # Not necessary, but may speed up indexing
-    # Uses more memory since cmat temporarily replicates X
-    cmat = np.zeros( (M, nx) )
-    pmat = np.zeros( (M, ny) )
-    for i in range(nx):
-        cmat[:,i] = X[ind2ij[:,0], ind2ij[:,1],i].ravel()
-    for i in range(ny):
-        pmat[:,i] = Y[ind2ij[:,0], ind2ij[:,1],i].ravel()
-    
-    # Perform T-test at each edge
-    t_stat = np.zeros( M )
-    for i in range(M):
-        # compute ttest2, assume independent random samples
-        t = ttest2(cmat[i,:], pmat[i,:])
-    
-        t_stat[i] = t
+    # Find network components of the observed data
+    model = _TwoSample(nx)
+    reledg, comp, sz_links = _observed_components(d_stacked, model, [THRESH], TAIL, N)
+    ADJ = _component_matrix(reledg[0], comp[0], N)
 
-    if TAIL == 'both':
-        t_stat = np.abs( t_stat )
-    elif TAIL == 'left':
-        t_stat = -t_stat
-    elif TAIL == 'right':
-        pass
-    else:
-        raise('Tail option not recognized')
- 
-    # Threshold   
-    ind_t = np.where( t_stat > THRESH )
-    
-    # Suprathreshold adjacency matrix
-    ADJ = np.zeros( (N,N) )
-    reledg = ind2ij[ind_t[0]] # relevant edges
-    ADJ[ reledg[:,0], reledg[:,1] ] = 1 # this yields a binary matrix, selecting the edges that are above threshold
-    ADJ = ADJ + ADJ.T
-
-    # Find network components
-    G = netwx.from_numpy_matrix(ADJ)
-    # Return connected components as subgraphs.
-    comp_list = list(netwx.connected_component_subgraphs(G))
-
-    # store the number of edges for each subgraph component 
-    nr_edges_per_component = np.zeros( len(comp_list) )
-    nr_edges_per_component_bigenough = []
-    
-    for idx, componentG in enumerate(comp_list):
-        nr_edges_per_component[idx] = componentG.number_of_edges()
+    nullargs = (d_stacked, model, [THRESH], TAIL, N, None)
+    PVAL, NULL = _permutation_test(nullargs, sz_links, K, n_jobs, random_state,
+                                   early_stop, alpha, confidence,
+                                   checkpoint, checkpoint_every, resume_from,
+                                   progress = progress, timing = timing)
         
-        # if number of edges bigger than zero
-        if nr_edges_per_component[idx] > 0:
-            nr_edges_per_component_bigenough.append(nr_edges_per_component[idx])
-            
-            # store the number of edges of the component as value in the adjacency matrix
-            for ed in componentG.edges():
-                ADJ[ed[0],ed[1]] = ADJ[ed[1],ed[0]] = idx + 1
-                # if we would like to store the number of edges per component
-                # ADJ[ed[0],ed[1]] = ADJ[ed[1],ed[0]] = nr_edges_per_component[idx]
-    
-    # renaming
-    sz_links = nr_edges_per_component_bigenough
-    
-    if len(sz_links) > 0:
-        max_sz = np.max(sz_links)
+    return (PVAL[0], ADJ, NULL)
+
+def compute_nbs_sweep(X, Y, THRESH, K = 1000, TAIL = 'both', n_jobs = 1, random_state = None,
+                      early_stop = False, alpha = 0.05, confidence = 0.99,
+                      checkpoint = None, checkpoint_every = 100, resume_from = None,
+                      progress = None, timing = None):
+    """ Computes the NBS for several thresholds with one set of permutations
+
+    Equivalent to calling `compute_nbs` for each threshold with the same
+    random_state, but the t-statistics of each permutation are computed
+    only once and shared by all thresholds.
+
+    Parameters
+    ----------
+    X, Y : ndarray
+        See `compute_nbs`.
+
+    THRESH : sequence of floats
+        T-statistic thresholds, e.g. [2.5, 3, 3.5, 4]
+
+    K, TAIL, n_jobs, random_state, early_stop, alpha, confidence,
+    checkpoint, checkpoint_every, resume_from, progress, timing :
+        See `compute_nbs`. With early_stop, the permutations stop once the
+        p-values of all thresholds are decided. The progress callback gets
+        perm_max, observed_max and pval as arrays with one entry per
+        threshold.
+
+    Returns
+    -------
+    PVAL, ADJ, NULL : lists
+        The results of `compute_nbs`, one list element per threshold.
+    """
+    THRESH = list(THRESH)
+    nx = X.shape[2]
+    N = X.shape[0]
+    d_stacked = _vectorize(X, Y)
+
+    # Find network components of the observed data
+    model = _TwoSample(nx)
+    reledg, comp, sz_links = _observed_components(d_stacked, model, THRESH, TAIL, N)
+    ADJ = [ _component_matrix(reledg[j], comp[j], N) for j in range(len(THRESH)) ]
+
+    nullargs = (d_stacked, model, THRESH, TAIL, N, None)
+    PVAL, NULL = _permutation_test(nullargs, sz_links, K, n_jobs, random_state,
+                                   early_stop, alpha, confidence,
+                                   checkpoint, checkpoint_every, resume_from,
+                                   progress = progress, timing = timing)
+
+    return (PVAL, ADJ, [ NULL[:,j:j+1] for j in range(len(THRESH)) ])
+
+def compute_nbs_sparse(D, nx, N, THRESH, K = 1000, TAIL = 'both', n_jobs = 1,
+                       random_state = None, early_stop = False, alpha = 0.05,
+                       confidence = 0.99, checkpoint = None, checkpoint_every = 100,
+                       resume_from = None, chunk_size = 100000, block_size = 100,
+                       progress = None, timing = None):
+    """ Computes the NBS for pre-vectorized data without dense matrices
+
+    Out-of-core variant of `compute_nbs` for high-resolution networks.
+    The connectivity values of both populations are given as one
+    (M, nx+ny) array of the upper triangular edges, which may be a
+    (float32) memmap on disk. The edges are read in chunks, and the
+    components are returned as edge lists instead of an N x N matrix.
+
+    Parameters
+    ----------
+    D : ndarray
+        (M, nx+ny) array, where M = N*(N-1)/2. Row m holds the connectivity
+        values of the m-th edge in the order of np.triu_indices(N, 1),
+        the first nx columns belong to population X, the others to Y.
+
+    nx : integer
+        Number of members of population X.
+
+    N : integer
+        Number of nodes.
+
+    THRESH, K, TAIL, n_jobs, random_state, early_stop, alpha, confidence,
+    checkpoint, checkpoint_every, resume_from, progress, timing :
+        See `compute_nbs`.
+
+    chunk_size : integer, default = 100000, optional.
+        Number of edges read from D at once.
+
+    block_size : integer, default = 100, optional.
+        Number of permutations computed per pass over D.
+
+    Returns
+    -------
+    PVAL : ndarray
+        p-values for each component
+
+    COMP : list of ndarray
+        For each component, the (E,2) array of node index pairs (i < j)
+        of its edges. COMP[i] corresponds to PVAL[i].
+
+    NULL : ndarray
+        See `compute_nbs`.
+    """
+    M, n = D.shape
+    assert M == N * (N - 1) / 2
+    assert 0 < nx < n
+
+    # Find network components of the observed data
+    model = _TwoSample(nx)
+    reledg, comp, sz_links = _observed_components(D, model, [THRESH], TAIL, N, chunk_size)
+    if len(sz_links[0]) == 0:
+        # np.split would return one empty component
+        COMP = []
     else:
-        max_sz = 0        
+        order = np.argsort(comp[0], kind = 'mergesort')
+        COMP = np.split( reledg[0][order], np.cumsum(sz_links[0][:-1]).astype(np.int64) )
 
-    if False:
-        # additionally, store all the components in the matrix with the value of their number of edges
-        all_components = np.zeros( (N,N) )
-        for idx, componentG in enumerate(comp_list):
-            
-            tmp_max = netwx.to_numpy_matrix( componentG , nodelist = range(N) )
-            # set nonzero to number of edges
-            tmp_max[tmp_max!=0.0] = componentG.number_of_edges()
-            all_components[:,:] = all_components[:,:] + tmp_max
-    
-    print "Max component size is: %s" % max_sz
-        
-    # Empirically estimate null distribution of maximum component size by
-    # generating K independent permutations.
-    print "=====================================================" 
-    print "Estimating null distribution with permutation testing"
-    print "====================================================="
-    
-    hit=0.0
-    NULL = np.zeros( (K, 1) )
-    # stack matrices for permutation
-    d_stacked = np.hstack( (cmat, pmat) )
+    nullargs = (D, model, [THRESH], TAIL, N, chunk_size)
+    PVAL, NULL = _permutation_test(nullargs, sz_links, K, n_jobs, random_state,
+                                   early_stop, alpha, confidence,
+                                   checkpoint, checkpoint_every, resume_from,
+                                   block_size, progress, timing)
 
-    for k in range(K):
-        # Randomize
-        indperm = np.random.permutation( nx+ny )
-        d = d_stacked[:, indperm].copy()
+    return (PVAL[0], COMP, NULL)
 
-        #################
-        
-        # Perform T-test at each edge
-        t_stat_perm = np.zeros( M )
-        for i in range(M):
-            # assume independent random samples
-            t = ttest2(d[i,:nx], d[i,nx:nx+ny])
-        
-            t_stat_perm[i] = t
-        
-        if TAIL == 'both':
-            t_stat_perm = np.abs( t_stat_perm )
-        elif TAIL == 'left':
-            t_stat_perm = -t_stat_perm
-        elif TAIL == 'right':
-            pass
-        else:
-            raise('Tail option not recognized')
-     
-        # Threshold   
-        ind_t = np.where( t_stat_perm > THRESH )
-        
-        # Suprathreshold adjacency matrix
-        adj_perm = np.zeros( (N,N) )
-        reledg = ind2ij[ind_t[0]] # relevant edges
-        adj_perm[ reledg[:,0], reledg[:,1] ] = 1 # this yields a binary matrix, selecting the edges that are above threshold
-        adj_perm = adj_perm + adj_perm.T
-        
-        # Find network components
-        G = netwx.from_numpy_matrix(adj_perm)
-        # Return connected components as subgraphs.
-        comp_list = list(netwx.connected_component_subgraphs(G))
-        
-        # store the number of edges for each subgraph component 
-        nr_edges_per_component = np.zeros( len(comp_list) )
-        for idx, componentG in enumerate(comp_list):
-            nr_edges_per_component[idx] = componentG.number_of_edges()
-        
-        # more then one node (= at least one edge)
-        nr_edges_per_component_bigenough = nr_edges_per_component[nr_edges_per_component>0]
-        
-        # renaming
-        sz_links_perm = nr_edges_per_component_bigenough
-        
-        if len(sz_links_perm) > 0:
-            sz_links_perm_max = np.max(sz_links_perm)
-        else:
-            sz_links_perm_max = 0
-    
-        NULL[k] = sz_links_perm_max        
 
-        # if the component size of this random permutation is bigger than
-        # the component size of the group difference computed above, this is a hit
-        if NULL[k] >= max_sz:
-            hit = hit + 1
-            
-        print "Perm %d of %d. Perm max is: %d. Observed max is: %d. P-val estimate is: %0.3f" % ((k+1),K,NULL[k],max_sz,hit/(k+1))
+def compute_nbs_glm(X, design, contrast, THRESH, K = 1000, TAIL = 'both', n_jobs = 1,
+                    random_state = None, early_stop = False, alpha = 0.05,
+                    confidence = 0.99, checkpoint = None, checkpoint_every = 100,
+                    resume_from = None, chunk_size = 10000, block_size = 100,
+                    progress = None, timing = None):
+    """ Computes the NBS for a general linear model with covariates
 
-    # Calculate p-values for each component
-    PVAL = np.zeros( len(sz_links) )
-    for i in range( len(sz_links) ):
-        PVAL[i] = len( NULL[NULL >= sz_links[i]] ) * 1.0 / K
-        
-    return (PVAL, ADJ, NULL)
+    The t-test of `compute_nbs` is replaced by the t-statistic of a
+    contrast in a general linear model, e.g. a group difference adjusted
+    for age and sex. The permutations follow the Freedman-Lane method:
+    the residuals of the model without the effect of interest are
+    permuted. All edges and permutations are evaluated with matrix
+    products instead of one model fit per edge.
+
+    Parameters
+    ----------
+    X : ndarray
+        N x N x n array, the connectivity matrices of all n subjects.
+
+    design : ndarray
+        n x p design matrix of full column rank, e.g. two group indicator
+        columns followed by the covariates.
+
+    contrast : ndarray
+        p vector, e.g. [1, -1, 0, 0] to test group one against group two.
+
+    THRESH : float
+        Threshold of the contrast t-statistic.
+
+    TAIL : {'both', 'left', 'right'}, optional
+        'both'  - alternative hypothesis is that the contrast is not zero (default)
+        'left'  - the contrast is negative
+        'right' - the contrast is positive
+
+    K, n_jobs, random_state, early_stop, alpha, confidence,
+    checkpoint, checkpoint_every, resume_from, progress, timing :
+        See `compute_nbs`.
+
+    chunk_size : integer, default = 10000, optional.
+        Number of edges evaluated at once.
+
+    block_size : integer, default = 100, optional.
+        Number of permutations evaluated with one matrix product. The
+        product of a chunk takes chunk_size * p * block_size floats, e.g.
+        32 MB for the defaults and p = 4, in each job.
+
+    Returns
+    -------
+    PVAL, ADJ, NULL : ndarray
+        See `compute_nbs`.
+    """
+    N = X.shape[0]
+    d_stacked = _vectorize(X)
+    if len(design) != d_stacked.shape[1]:
+        raise ValueError('Design matrix needs one row per subject')
+
+    # Find network components of the observed data
+    model = _FreedmanLane(design, contrast)
+    reledg, comp, sz_links = _observed_components(d_stacked, model, [THRESH], TAIL, N,
+                                                  chunk_size)
+    ADJ = _component_matrix(reledg[0], comp[0], N)
 
+    nullargs = (d_stacked, model, [THRESH], TAIL, N, chunk_size)
+    PVAL, NULL = _permutation_test(nullargs, sz_links, K, n_jobs, random_state,
+                                   early_stop, alpha, confidence,
+                                   checkpoint, checkpoint_every, resume_from,
+                                   block_size, progress, timing)
 
-def setdiff2d(X, Y):
+    return (PVAL[0], ADJ, NULL)
+
+def _in2d(X, Y):
+    """ Boolean mask of the rows of X that are also rows of Y
+
+    Integer index pairs are packed into one integer per row, other
+    types are compared as raw bytes of the rows, after mapping -0.0 to
+    0.0. Rows with NaN are never found. The membership test is then a
+    single vectorized np.in1d call.
+
+    Parameters
+    ----------
+    X, Y : ndarray
+           (n,2) and (m,2) arrays representing indices
+
+    Returns
+    -------
+    X : ndarray
+        X as (n,2) array
+    mask : ndarray
+        (n,) boolean array
+    """
+    X = np.asarray(X).reshape(-1, 2)
+    Y = np.asarray(Y).reshape(-1, 2)
+    if len(X) == 0 or len(Y) == 0:
+        return X, np.zeros(len(X), dtype = bool)
+
+    if X.dtype.kind in 'iu' and Y.dtype.kind in 'iu':
+        # in Python integers, small integer types would overflow
+        lo = min(int(X.min()), int(Y.min()))
+        base = max(int(X.max()), int(Y.max())) - lo + 1
+        if base < 2**31:
+            xkey = (X[:,0].astype(np.int64) - lo) * base + (X[:,1].astype(np.int64) - lo)
+            ykey = (Y[:,0].astype(np.int64) - lo) * base + (Y[:,1].astype(np.int64) - lo)
+            return X, np.in1d(xkey, ykey)
+
+    dtype = np.result_type(X, Y)
+    row = np.dtype( (np.void, 2 * dtype.itemsize) )
+    Xn = np.ascontiguousarray(X, dtype = dtype)
+    Yn = np.ascontiguousarray(Y, dtype = dtype)
+    if dtype.kind in 'fc':
+        # equal values must have equal bytes, adding zero maps -0.0 to 0.0
+        Xn = Xn + dtype.type(0)
+        Yn = Yn + dtype.type(0)
+    mask = np.in1d(Xn.view(row).ravel(), Yn.view(row).ravel())
+    if dtype.kind in 'fc':
+        mask &= ~np.any(np.isnan(Xn), axis = 1)
+    return X, mask
+
+def setdiff2d(X, Y, return_indices = False):
     """ Differences of two index arrays
     
     Parameters
     ----------
     X, Y : ndarray
            (n,2) arrays representing indices
+
+    return_indices : boolean, default = False, optional
+           Also return the row indices into X
            
     Returns
     -------
     Z : ndarray
-        array of elements in X, that are not in Y
+        array of elements in X, that are not in Y, in the order of X
+    idx : ndarray
+        indices of these elements in X, such that Z = X[idx].
+        Only provided if return_indices is True.
     """
-    n = X.shape[0]
-    m = Y.shape[0]
-    Z = []
-    for i in xrange(n):
-        test = X[i,:]
-        hit = False
-        for j in xrange(m):
-            if test[0] == Y[j,0] and test[1] == Y[j,1]:
-                hit = True
-                break
-        if not hit:
-            Z.append(test)
-    return np.array(Z)
-
-def intersect2d(X, Y):
+    X, mask = _in2d(X, Y)
+    idx = np.nonzero(~mask)[0]
+    if return_indices:
+        return X[idx], idx
+    return X[idx]
+
+def intersect2d(X, Y, return_indices = False):
     """ Intersection of two index arrays
     
     Parameters
     ----------
     X, Y : ndarray
            (n,2) arrays representing indices
+
+    return_indices : boolean, default = False, optional
+           Also return the row indices into X
            
     Returns
     -------
     Z : ndarray
-        array of elements in X, that are also in Y
+        array of elements in X, that are also in Y, in the order of X
+    idx : ndarray
+        indices of these elements in X, such that Z = X[idx].
+        Only provided if return_indices is True.
     """
-    n = X.shape[0]
-    m = Y.shape[0]
-    Z = []
-    for i in xrange(n):
-        test = X[i,:]
-        hit = False
-        for j in xrange(m):
-            if test[0] == Y[j,0] and test[1] == Y[j,1]:
-                hit = True
-                break
-        if hit:
-            Z.append(test)
-    return np.array(Z)
-
+    X, mask = _in2d(X, Y)
+    idx = np.nonzero(mask)[0]
+    if return_indices:
+        return X[idx], idx
+    return X[idx]
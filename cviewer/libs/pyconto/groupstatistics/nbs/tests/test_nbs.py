@@ -0,0 +1,34 @@
+""" Tests of the network-based statistic """
+
+import unittest
+
+import numpy as np
+
+from cviewer.libs.pyconto.groupstatistics.nbs import compute_nbs, compute_nbs_sparse
+
+class TestNoComponents(unittest.TestCase):
+
+    def test_sparse_all_zero(self):
+        N = 5
+        D = np.zeros( (N * (N - 1) / 2, 6) )
+        PVAL, COMP, NULL = compute_nbs_sparse(D, 3, N, 1.0, K = 10, random_state = 0)
+        self.assertEqual(len(PVAL), 0)
+        self.assertEqual(COMP, [])
+        self.assertEqual(len(NULL), 10)
+
+    def test_sparse_matches_dense(self):
+        rs = np.random.RandomState(0)
+        N = 8
+        X = rs.rand(N, N, 6)
+        Y = rs.rand(N, N, 6) + 0.3
+        PVAL, ADJ, NULL = compute_nbs(X, Y, 1.5, K = 20, random_state = 0)
+        i, j = np.triu_indices(N, 1)
+        D = np.hstack( (X[i, j, :], Y[i, j, :]) )
+        PVAL_s, COMP, NULL_s = compute_nbs_sparse(D, 6, N, 1.5, K = 20, random_state = 0)
+        self.assertTrue(len(PVAL) > 0)
+        self.assertEqual(len(COMP), len(PVAL_s))
+        np.testing.assert_array_equal(PVAL_s, PVAL)
+        np.testing.assert_array_equal(NULL_s, NULL)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,9 @@
 import os, os.path
 import tempfile
 from threading import Thread
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 # Enthought library imports
 from traits.api import HasTraits, Instance, Any, Str, File, List, Bool, Property, cached_property
@@ -213,6 +216,100 @@ class CFile(HasTraits):
     
         self.obj = cfflib.load(filepath)
             
+    def get_network_by_name(self, name):
+        """ Returns the CNetwork with the given name """
+        for net in self.connectome_network:
+            if net.obj.name == name:
+                return net
+        raise KeyError('No connectome network named %s' % name)
+
+    def get_track_by_name(self, name):
+        """ Returns the CTrack with the given name """
+        for track in self.connectome_track:
+            if track.obj.name == name:
+                return track
+        raise KeyError('No connectome track named %s' % name)
+
+    def get_data_by_name(self, name):
+        """ Returns the CData with the given name """
+        for data in self.connectome_data:
+            if data.obj.name == name:
+                return data
+        raise KeyError('No connectome data named %s' % name)
+
+    def stack_networks(self, names, edge_key, triu = False, n_jobs = 1):
+        """ Stacks the matrices of several networks into one array
+        
+        The networks are loaded and their sparse matrices built one after
+        the other in the calling thread, as loading extracts files and
+        notifies the user interface. Meanwhile, a pool of threads writes
+        the matrices already built into their slice of the result; this
+        conversion runs in NumPy without holding the interpreter lock,
+        but takes a small part of the time unless the matrices are already
+        cached, so the default is a single thread. All networks must have the same nodes, which are in the order of
+        node_order() of the networks.
+        
+        Parameters
+        ----------
+        names : list of strings
+            names of the connectome networks, one per subject
+        edge_key : string
+            the edge attribute holding the values, see CNetwork.matrix
+        triu : bool, optional
+            If True, return only the edges above the diagonal, in the
+            order of np.triu_indices(N, 1), as for nbs.compute_nbs_sparse
+        n_jobs : integer, optional
+            number of threads writing into the result, the calling thread
+            if 1
+            
+        Returns
+        -------
+        stack : ndarray
+            float32 array, (N, N, subjects) or (N*(N-1)/2, subjects) if triu
+        """
+        networks = [ self.get_network_by_name(n) for n in names ]
+        if len(networks) == 0:
+            raise ValueError('No networks to stack')
+        
+        # the first network defines the node order
+        nodes = networks[0].node_order()
+        N = len(nodes)
+        if triu:
+            stack = np.zeros( (N * (N - 1) // 2, len(networks)), dtype = np.float32 )
+        else:
+            stack = np.zeros( (N, N, len(networks)), dtype = np.float32 )
+        
+        def fill(i, csr):
+            mat = csr.tocoo()
+            if triu:
+                up = mat.row < mat.col
+                r, c = mat.row[up], mat.col[up]
+                stack[r * (2 * N - r - 1) // 2 + c - r - 1, i] = mat.data[up]
+            else:
+                stack[mat.row, mat.col, i] = mat.data
+        
+        pool = ThreadPool(n_jobs) if n_jobs > 1 else None
+        try:
+            pending = []
+            for i, net in enumerate(networks):
+                if net.node_order() != nodes:
+                    raise ValueError('Network %s does not have the nodes of network %s' % \
+                                     (net.obj.name, networks[0].obj.name))
+                csr = net.matrix(edge_key, sparse = True)
+                if pool is None:
+                    fill(i, csr)
+                else:
+                    pending.append( pool.apply_async(fill, (i, csr)) )
+                logger.debug('Stacked network %s' % net.obj.name)
+            # raises the errors of the threads
+            for result in pending:
+                result.get()
+        finally:
+            if not pool is None:
+                pool.close()
+                pool.join()
+        return stack
+
     def close_cfile(self):
 #        if not self.obj.iszip:
 #            logger.info("Save connectome file data.")
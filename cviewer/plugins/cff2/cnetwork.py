@@ -7,6 +7,9 @@
 # Standard library imports
 import os
 
+import numpy as np
+import scipy.sparse as sp
+
 # Enthought library imports
 from traits.api import HasTraits, Str, Bool, CBool, Any, Dict, implements, \
       List, Instance, DelegatesTo, Property
@@ -23,6 +26,171 @@ import logging
 logger = logging.getLogger('root.'+__name__)
 
 from cbase import CBase
+from network_cache import NetworkCache, FORMATS
+from network_metrics import NetworkMetrics
+import network_export
+
+class NetworkColumns(object):
+    """ Columnar representation of the nodes and edges of a graph
+    
+    The nodes are numbered in the order of `nodes`, the edges are given
+    by the node numbers `src` and `dst`, once per edge also for undirected
+    graphs. Each node and edge attribute is
+    one NumPy array in `node` and `edge`, with one row per node or edge:
+    
+    - integers give an int64 column, other numbers a float64 column with
+      NaN for missing values. Integers with missing values are zero in
+      their column, and `node_mask` and `edge_mask` hold the masks of
+      the present values of such columns, see float_values.
+    - sequences of numbers of equal length, or strings of such tuples
+      as "(1.0, 2.0, 3.0)", give a 2d float64 column
+    - other values give an object column with None for missing values
+    
+    The graph attributes are kept as they are in `graph`.
+    
+    Slicing the edges with `edge_slice` returns views of these arrays.
+    """
+    
+    def __init__(self, nodes, src, dst, node, edge, directed = False, graph = None,
+                 node_mask = None, edge_mask = None):
+        self.nodes = nodes
+        self.src = src
+        self.dst = dst
+        self.node = node
+        self.edge = edge
+        self.directed = directed
+        self.graph = graph or {}
+        self.node_mask = node_mask or {}
+        self.edge_mask = edge_mask or {}
+        self._index = None
+    
+    @classmethod
+    def from_graph(cls, g, nodes):
+        """ Builds the columns of graph g, traversing its nodes and edges once """
+        index = dict( (n, i) for i, n in enumerate(nodes) )
+        
+        node = {}
+        for i, n in enumerate(nodes):
+            for k, v in g.node[n].iteritems():
+                node.setdefault(k, [None] * len(nodes))[i] = v
+        
+        src, dst, edge = [], [], {}
+        for i, (u, v, d) in enumerate(g.edges_iter(data = True)):
+            src.append(index[u])
+            dst.append(index[v])
+            for k, val in d.iteritems():
+                if not k in edge:
+                    edge[k] = [None] * i
+                edge[k].append(val)
+            for k in edge:
+                if len(edge[k]) == i:
+                    edge[k].append(None)
+        
+        tables = []
+        for values in (node, edge):
+            columns, masks = {}, {}
+            for k, v in values.iteritems():
+                columns[k], mask = _column(v)
+                if not mask is None:
+                    masks[k] = mask
+            tables.append( (columns, masks) )
+        
+        return cls(_object_column(nodes),
+                   np.array(src, dtype = np.int64),
+                   np.array(dst, dtype = np.int64),
+                   tables[0][0], tables[1][0], g.is_directed(), dict(g.graph),
+                   tables[0][1], tables[1][1])
+    
+    def __len__(self):
+        return len(self.src)
+    
+    def edge_slice(self, start = None, stop = None, step = None):
+        """ The edges start:stop:step, sharing the memory of these columns """
+        sl = slice(start, stop, step)
+        res = NetworkColumns(self.nodes, self.src[sl], self.dst[sl], self.node,
+                             dict( (k, v[sl]) for k, v in self.edge.iteritems() ),
+                             self.directed, self.graph, self.node_mask,
+                             dict( (k, v[sl]) for k, v in self.edge_mask.iteritems() ))
+        res._index = self._index
+        return res
+    
+    def float_values(self, table, key):
+        """ The float64 values of a numerical attribute, NaN for missing values
+        
+        Parameters
+        ----------
+        table : {'node', 'edge'}
+        key : string
+            the attribute
+        """
+        val = getattr(self, table)[key].astype(np.float64)
+        mask = getattr(self, table + '_mask').get(key)
+        if not mask is None:
+            val[~mask] = np.nan
+        return val
+    
+    def node_index(self, ids):
+        """ Row numbers of the given node ids """
+        if self._index is None:
+            self._index = dict( (n, i) for i, n in enumerate(self.nodes) )
+        return np.array( [ self._index[n] for n in ids ], dtype = np.int64 )
+
+def _column(values):
+    """ A NumPy column of attribute values, see NetworkColumns
+    
+    Returns the column and the mask of the present values of integer
+    columns with missing values, None for other columns.
+    """
+    col = _values_column(values)
+    if col.dtype.kind == 'i' and None in values:
+        return col, np.array( [ v is not None for v in values ] )
+    return col, None
+
+def _values_column(values):
+    present = [ v for v in values if v is not None ]
+    if len(present) == 0:
+        return np.array(values, dtype = object)
+    
+    if all( isinstance(v, (int, long, float, np.number)) and not isinstance(v, bool) for v in present ):
+        if all( isinstance(v, (int, long, np.integer)) for v in present ) and \
+           all( -2**63 <= v < 2**63 for v in present ):
+            return np.array( [ 0 if v is None else v for v in values ], dtype = np.int64 )
+        return np.array( [ np.nan if v is None else v for v in values ], dtype = np.float64 )
+    
+    if all( isinstance(v, basestring) for v in present ) and \
+       all( v[:1] in '([' and v[-1:] in ')]' for v in present ):
+        # tuples stored as strings, e.g. node positions in GraphML
+        present = [ v[1:-1].split(',') for v in present ]
+    
+    if all( isinstance(v, (tuple, list, np.ndarray)) for v in present ) and \
+       len(set( len(v) for v in present )) == 1:
+        try:
+            vec = np.array(present, dtype = np.float64)
+        except ValueError:
+            return _object_column(values)
+        if len(present) == len(values):
+            return vec
+        col = np.nan * np.ones( (len(values), vec.shape[1]) )
+        col[ np.array( [ v is not None for v in values ] ) ] = vec
+        return col
+    
+    return _object_column(values)
+
+def _object_column(values):
+    col = np.empty(len(values), dtype = object)
+    col[:] = values
+    return col
+
+def _network_cache():
+    """ The network cache configured in the preferences, None if disabled """
+    ui = preference_manager.cviewerui
+    if not ui.networkcache:
+        return None
+    if ui.networkcachepath:
+        directory = ui.networkcachepath
+    else:
+        directory = None
+    return NetworkCache(directory, ui.networkcachesize * 1024 ** 2)
 
 class CNetwork(CBase):
     """ The implementation of the Connectome Networks """
@@ -32,11 +200,195 @@ class CNetwork(CBase):
     
     graph = Property(Any, depends_on = [ 'obj' ])
     
+    # private traits
+    ###########
+    
+    # the graph the cached views were computed from
+    _cache_graph = Any
+    
+    # the node ids in matrix order
+    _nodes = Any
+    
+    # the matrix of each (edge key, sparse) pair
+    _matrix_cache = Dict
+    
+    # the NetworkColumns of the graph
+    _columns = Any
+    
+    # the NetworkMetrics of each edge key
+    _metrics_cache = Dict
+    
     def _get_graph(self):
         if not self.loaded:
             self.load()
         return self.obj.data
 
+    def _obj_changed(self):
+        self.invalidate()
+
+    def load(self):
+        """ Loads the network, through the network cache if it is enabled """
+        cache = _network_cache()
+        if cache is None or not self.obj.fileformat in FORMATS:
+            super(CNetwork, self).load()
+        else:
+            self.obj.load(custom_loader = cache.load_network)
+            self.loaded = True
+
+    def close(self):
+        super(CNetwork, self).close()
+        self.invalidate()
+
+    def invalidate(self):
+        """ Discards the cached views of the graph
+        
+        They are discarded automatically when obj.data is replaced, but
+        not when the graph is modified in place, which requires this call.
+        """
+        self._cache_graph = None
+        self._nodes = None
+        self._matrix_cache = {}
+        self._columns = None
+        self._metrics_cache = {}
+
+    def _cached_graph(self):
+        """ The graph, discarding the cached views if it was replaced """
+        g = self.graph
+        if not g is self._cache_graph:
+            self.invalidate()
+            self._cache_graph = g
+        return g
+
+    def node_order(self):
+        """ Returns the node ids in the order of the rows of matrix()
+        
+        Node ids which are all integers (or strings of integers) are sorted
+        numerically, such that index i corresponds to node i+1 for the
+        usual node ids 1..N, otherwise they are sorted as they are.
+        """
+        g = self._cached_graph()
+        if self._nodes is None:
+            nodes = g.nodes()
+            try:
+                self._nodes = sorted(nodes, key = int)
+            except (TypeError, ValueError):
+                self._nodes = sorted(nodes)
+        return self._nodes
+
+    def columns(self):
+        """ Returns the columnar representation of the graph
+        
+        It is built once and cached until the graph changes. The node
+        rows follow node_order(). See NetworkColumns.
+        """
+        g = self._cached_graph()
+        if self._columns is None:
+            self._columns = NetworkColumns.from_graph(g, self.node_order())
+        return self._columns
+
+    def matrix(self, edge_key = None, sparse = False):
+        """ Returns the connectivity matrix of an edge value
+        
+        The matrix is computed once per edge key and cached until the
+        graph changes. Do not modify the returned matrix in place.
+        
+        Parameters
+        ----------
+        edge_key : string, optional
+            Numerical edge attribute holding the values. Edges without this
+            attribute are zero. If None, every edge has the value 1.
+        sparse : bool, optional
+            If True, return a scipy.sparse CSR matrix instead of a
+            dense array.
+            
+        Returns
+        -------
+        mat : ndarray or scipy.sparse.csr_matrix
+            N x N matrix with rows and columns in the order of node_order(),
+            symmetric for undirected graphs.
+        """
+        g = self._cached_graph()
+        cache = self._matrix_cache
+        if (edge_key, sparse) in cache:
+            return cache[(edge_key, sparse)]
+        
+        if (edge_key, True) in cache:
+            csr = cache[(edge_key, True)]
+        else:
+            csr = self._build_matrix(edge_key)
+            cache[(edge_key, True)] = csr
+        if sparse:
+            return csr
+        
+        mat = csr.toarray()
+        mat.flags.writeable = False
+        cache[(edge_key, False)] = mat
+        return mat
+
+    def metrics(self, edge_key = None):
+        """ Returns the graph metrics of the network
+        
+        The NetworkMetrics object is created once per edge key and cached
+        until the graph changes, together with the metrics it computed.
+        
+        Parameters
+        ----------
+        edge_key : string, optional
+            Edge attribute used as weight for the weighted metrics,
+            all weights are 1 if None.
+        """
+        self._cached_graph()
+        if not edge_key in self._metrics_cache:
+            self._metrics_cache[edge_key] = NetworkMetrics(self.matrix(edge_key, sparse = True))
+        return self._metrics_cache[edge_key]
+
+    def write_gexf(self, fname, chunk_size = network_export.DEFAULT_CHUNK_SIZE):
+        """ Writes the network in the GEXF format, readable by Gephi
+        
+        The file is streamed from the columns() of the network in chunks
+        of nodes and edges, the graph itself is not modified.
+        See network_export.write_gexf.
+        
+        Parameters
+        ----------
+        fname : string or file
+            file name or file open for writing
+        chunk_size : integer, optional
+            number of nodes or edges converted to text at once
+        """
+        network_export.write_gexf(self.columns(), fname, chunk_size)
+
+    def write_graphml(self, fname, chunk_size = network_export.DEFAULT_CHUNK_SIZE):
+        """ Writes the network in the GraphML format
+        
+        Streamed as write_gexf, see network_export.write_graphml.
+        """
+        network_export.write_graphml(self.columns(), fname, chunk_size)
+
+    def _build_matrix(self, edge_key):
+        """ The CSR matrix of an edge key, from the edge columns """
+        cols = self.columns()
+        row, col = cols.src, cols.dst
+        if edge_key is None:
+            val = np.ones( len(row) )
+        elif edge_key in cols.edge:
+            val = cols.float_values('edge', edge_key)
+            # missing values
+            valid = ~np.isnan(val)
+            row, col, val = row[valid], col[valid], val[valid]
+        else:
+            row, col, val = row[:0], col[:0], np.zeros(0)
+        
+        if not cols.directed:
+            # mirror the edges, without duplicating the self-loops
+            off = row != col
+            row, col, val = np.concatenate( (row, col[off]) ), \
+                np.concatenate( (col, row[off]) ), np.concatenate( (val, val[off]) )
+        
+        n = len(cols.nodes)
+        # duplicates of multigraphs are summed
+        return sp.coo_matrix( (val, (row, col)), shape = (n, n) ).tocsr()
+
     def __init__(self, **traits):
         super(CNetwork, self).__init__(**traits)
         
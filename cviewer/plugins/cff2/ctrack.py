@@ -7,6 +7,7 @@
 # Standard library imports
 import os
 import subprocess
+from hashlib import sha1
 
 # Enthought library imports
 from traits.api import HasTraits, Str, Bool, CBool, Any, Dict, implements, \
@@ -21,27 +22,244 @@ import logging
 logger = logging.getLogger('root.'+__name__)
 
 from cbase import CBase
+from track_file import TrackFile
+from packed_fibers import PackedFibers
+from fiber_metrics import FiberMetrics
+from fiber_label_index import FiberLabelIndex
+from spatial_index import SpatialIndex, DEFAULT_CELL_SIZE
 
 class CTrack(CBase):
     """ The implementation of the Connectome Track """
     
     obj = Instance(cfflib.CTrack)
     
+    # private traits
+    ###########
+    
+    # the memory-mapped TrackFile of the track
+    _trackfile = Any
+    
+    # the PackedFibers of all fibers
+    _packed = Any
+    
+    # the FiberMetrics of all fibers
+    _metrics = Any
+    
+    # the FiberLabelIndex of each fiber label CData name
+    _label_indexes = Dict
+    
+    # the SpatialIndex of the fiber points
+    _spatial_index = Any
     
     def __init__(self, **traits):
         super(CTrack, self).__init__(**traits)
     
-    def get_fibdata(self):
-        """ Return a Numpy Object of TrackVis fibers """
-        if not self.loaded:
-            self.load()
-         
-        if self.obj.get_fileformat() == 'TrackVis':
-            return self.obj.get_fibers_as_numpy()
-        else:
+    def _obj_changed(self):
+        self._close_trackfile()
+    
+    def track_file(self):
+        """ Returns the memory-mapped TrackVis file of the track
+        
+        The file is opened on first use, without loading the track, and
+        kept open until the track is closed. See TrackFile.
+        """
+        if self._trackfile is None:
+            self._trackfile = TrackFile.from_cfflib(self.obj)
+        return self._trackfile
+    
+    def _close_trackfile(self):
+        self._packed = None
+        self._metrics = None
+        self._label_indexes = {}
+        self._spatial_index = None
+        if not self._trackfile is None:
+            self._trackfile.close()
+            self._trackfile = None
+    
+    def close(self):
+        self._close_trackfile()
+        super(CTrack, self).close()
+    
+    def get_fibdata(self, indices = None):
+        """ Return a Numpy Object of TrackVis fibers
+        
+        The fibers are read-only views of the memory-mapped track file,
+        which are read from disk on access.
+        
+        Parameters
+        ----------
+        indices : slice, integer array or boolean mask, optional
+            the fibers to return, all if None
+        """
+        if self.obj.get_fileformat() != 'TrackVis':
+            return None
+        
+        try:
+            return self.track_file().fibers(indices)
+        except IOError, e:
+            # e.g. tracks created in memory without a source file
+            logger.debug('Can not memory-map the track: %s' % e)
+            if not self.loaded:
+                self.load()
+            fibers = self.obj.get_fibers_as_numpy()
+            if indices is None or fibers is None:
+                return fibers
+            return fibers[indices]
+    
+    def get_packed_fibers(self, indices = None):
+        """ Return the fibers as PackedFibers
+        
+        All points are in one contiguous (P, 3) float32 array, see
+        PackedFibers. The packed fibers of the whole track are built once
+        and kept until the track is closed, subsets are taken from them.
+        Use PackedFibers.to_object_array and PackedFibers.from_fibers to
+        convert to and from the arrays of get_fibdata().
+        
+        Parameters
+        ----------
+        indices : slice, integer array or boolean mask, optional
+            the fibers to return, all if None
+        """
+        if self.obj.get_fileformat() != 'TrackVis':
             return None
+        
+        if self._packed is None:
+            try:
+                self._packed = self.track_file().packed()
+            except IOError, e:
+                logger.debug('Can not memory-map the track: %s' % e)
+                self._packed = PackedFibers.from_fibers(self.get_fibdata())
+        if indices is None:
+            return self._packed
+        return self._packed[indices]
     
     
+    def metrics(self):
+        """ Returns the per-fiber metrics of the track
+        
+        The FiberMetrics object is created once and kept until the track
+        is closed, together with the metrics it computed: endpoints,
+        length, start_end_distance, mean_curvature and angle.
+        """
+        if self._metrics is None:
+            self._metrics = FiberMetrics(self.get_packed_fibers())
+        return self._metrics
+    
+    def number_of_fibers(self):
+        """ Returns the number of fibers, without reading their points """
+        if self._packed is None:
+            try:
+                return len(self.track_file())
+            except IOError:
+                pass
+        return len(self.get_packed_fibers())
+    
+    def label_index(self, fiberlabels):
+        """ Returns the index of the fibers by their endpoint labels
+        
+        The index is built once per fiber label data and kept until the
+        track is closed. See FiberLabelIndex for the lookups, e.g. the
+        fibers between two regions or touching a region.
+        
+        Parameters
+        ----------
+        fiberlabels : CData
+            the (from, to) labels of the fibers of this track
+        """
+        name = fiberlabels.obj.name
+        if not name in self._label_indexes:
+            if not fiberlabels.loaded:
+                fiberlabels.load()
+            labels = fiberlabels.obj.data
+            n = self.number_of_fibers()
+            if len(labels) != n:
+                raise ValueError('%s has %d fiber labels for %d fibers' %
+                                 (name, len(labels), n))
+            self._label_indexes[name] = FiberLabelIndex(labels)
+        return self._label_indexes[name]
+    
+    def _fiber_subset(self, indices):
+        """ PackedFibers of some fibers, read from the file unless all are packed """
+        if self._packed is None:
+            try:
+                return self.track_file().packed(indices)
+            except IOError:
+                pass
+        return self.get_packed_fibers(indices)
+    
+    def _spatial_index_fname(self):
+        """ The file of the saved spatial index, in the spatial index directory
+        
+        The directory is set in the preferences, ~/.cviewer/spatial_index
+        if empty, which is private to the user as the saved indexes are
+        trusted. The file is named by a hash of the track path.
+        """
+        directory = preference_manager.cviewerui.spatialindexpath
+        if not directory:
+            directory = os.path.join(os.path.expanduser('~'), '.cviewer', 'spatial_index')
+        if self.obj.parent_cfile.iszip:
+            # the extracted track is removed on close
+            src = os.path.abspath(self.obj.parent_cfile.src) + ':' + self.obj.src
+        else:
+            src = os.path.abspath(self.track_file().fname)
+        if isinstance(src, unicode):
+            src = src.encode('utf-8')
+        return os.path.join(directory, sha1(src).hexdigest() + '.sidx.npz')
+    
+    def spatial_index(self, cell_size = DEFAULT_CELL_SIZE):
+        """ Returns the spatial index of the fibers for region of interest queries
+        
+        The index is loaded from its .sidx.npz file in the spatial index
+        directory if the fingerprint of the track file matches, or built
+        from the fibers on first use and saved there, and kept until
+        the track is closed. See SpatialIndex for the queries, e.g. the
+        fibers through a sphere or with an endpoint in a box.
+        
+        Parameters
+        ----------
+        cell_size : float, optional
+            edge length of the grid cells, in mm
+        """
+        if not self._spatial_index is None and self._spatial_index.cell_size == cell_size:
+            return self._spatial_index
+        
+        try:
+            tf = self.track_file()
+        except IOError, e:
+            # without a source file, the index is not saved
+            logger.debug('Can not memory-map the track: %s' % e)
+            tf = None
+        if tf is None:
+            fname = fingerprint = None
+        else:
+            fname = self._spatial_index_fname()
+            fingerprint = tf.fingerprint()
+            self._spatial_index = SpatialIndex.load(fname, self._fiber_subset,
+                                                    fingerprint, cell_size)
+            if not self._spatial_index is None:
+                return self._spatial_index
+        
+        # the grid covers the volume of the track, or the points if unknown
+        n = self.number_of_fibers()
+        if not tf is None and tf.header['dim'].min() > 0:
+            low = [0, 0, 0]
+            high = tf.header['dim'] * tf.header['voxel_size']
+        else:
+            points = self.get_packed_fibers().points
+            if len(points) > 0:
+                low, high = points.min(axis = 0), points.max(axis = 0)
+            else:
+                low = high = [0, 0, 0]
+        logger.info('Building the spatial index of %d fibers' % n)
+        self._spatial_index = SpatialIndex.build(self._fiber_subset, n, low, high, cell_size)
+        
+        if not fname is None:
+            try:
+                self._spatial_index.save(fname, fingerprint)
+            except (IOError, OSError), e:
+                logger.warning('Can not save the spatial index to %s: %s' % (fname, e))
+        return self._spatial_index
+    
     def launch_trackvis(self, volumefname = None):
         """ Launches TrackVis externally """
         logger.info("Launch TrackVis...")
@@ -66,11 +284,9 @@ class CTrack(CBase):
     def render_tracks(self):
         """ Renders the tracks in a separate window using DiPy Fos """
         from cviewer.libs.dipy.viz import fos
-        if not self.loaded:
-            self.load()
-            
-        # copy tracks for visualization
-        T = [i[0] for i in self.obj.data[0]]
+        
+        # views of the packed points for visualization
+        T = list(self.get_packed_fibers())
         r=fos.ren()
         fos.add(r,fos.line(T,fos.white,opacity=0.8))
         fos.show(r)
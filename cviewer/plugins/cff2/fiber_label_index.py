@@ -0,0 +1,125 @@
+""" Index of the fibers of a track by the labels of their endpoints
+
+The fiber labels of a tractography give the (from, to) region labels of
+the endpoints of each fiber. FiberLabelIndex sorts the fibers once by
+their label pair and by each of their labels, such that the fibers of a
+connection or of a region are found without scanning all labels.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+import numpy as np
+
+class FiberLabelIndex(object):
+    """ The fibers of each label pair and of each label
+
+    The fiber indices of a pair or label are a contiguous range of a
+    sorted array, found through a dictionary, such that a lookup takes
+    time proportional to the number of fibers returned.
+
+    Parameters
+    ----------
+    labels : (n, 2) array
+        the from and to label of each fiber
+    """
+
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+        if labels.ndim != 2 or labels.shape[1] < 2:
+            raise ValueError('The fiber labels must be a (n, 2) array')
+        labels = labels[:, :2].astype(np.int64)
+        self.labels = labels
+        n = len(labels)
+        if n > 0:
+            self._min = int(labels.min())
+            self._span = int(labels.max()) - self._min + 1
+        else:
+            self._min, self._span = 0, 1
+
+        # fibers by label pair
+        key = (labels[:,0] - self._min) * self._span + labels[:,1] - self._min
+        self._pair_fibers, self._pairs = _group( *_sort(key, np.arange(n), n) )
+
+        # fibers by label of either endpoint, once per fiber
+        other = labels[:,0] != labels[:,1]
+        region = np.concatenate( (labels[:,0], labels[other,1]) ) - self._min
+        fiber = np.concatenate( (np.arange(n), np.flatnonzero(other)) )
+        fiber, region = _sort(region, fiber, n)
+        self._region_fibers, self._regions = _group(fiber, region + self._min)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _pair_key(self, fromval, toval):
+        """ The key of a label pair, None if a label is out of range """
+        a = int(fromval) - self._min
+        b = int(toval) - self._min
+        if a < 0 or b < 0 or a >= self._span or b >= self._span:
+            return None
+        return a * self._span + b
+
+    def pairs(self):
+        """ The (from, to) label pairs having fibers """
+        return [ (k // self._span + self._min, k % self._span + self._min)
+                 for k in sorted(self._pairs) ]
+
+    def regions(self):
+        """ The labels of the endpoints of the fibers """
+        return sorted(self._regions)
+
+    def fibers(self, fromval, toval, symmetric = False):
+        """ Indices of the fibers from label fromval to label toval
+
+        If symmetric, the fibers from toval to fromval are included.
+        """
+        res = self._lookup(self._pair_fibers, self._pairs, self._pair_key(fromval, toval))
+        if symmetric and fromval != toval:
+            res = np.concatenate( (res, self._lookup(self._pair_fibers, self._pairs,
+                                                     self._pair_key(toval, fromval))) )
+        return res
+
+    def count(self, fromval, toval):
+        """ Number of fibers from label fromval to label toval """
+        start, stop = self._pairs.get( self._pair_key(fromval, toval), (0, 0) )
+        return stop - start
+
+    def region_fibers(self, regions):
+        """ Indices of the fibers with an endpoint in one of the labels
+
+        Parameters
+        ----------
+        regions : integer or sequence of integers
+        """
+        if np.isscalar(regions):
+            return self._lookup(self._region_fibers, self._regions, regions)
+        res = [ self._lookup(self._region_fibers, self._regions, r) for r in regions ]
+        if len(res) == 0:
+            return np.zeros(0, dtype = np.int64)
+        # fibers between two of the regions are found twice
+        return np.unique(np.concatenate(res))
+
+    def _lookup(self, fibers, ranges, key):
+        start, stop = ranges.get(key, (0, 0))
+        return fibers[start:stop]
+
+def _sort(keys, fibers, n):
+    """ The fibers sorted by their nonnegative keys then by fiber, and their keys """
+    if len(keys) == 0:
+        return fibers, keys
+    if keys.max() < np.iinfo(np.int64).max // n - 1:
+        # sorting values is faster than a stable argsort
+        combined = np.sort(keys * n + fibers)
+        return combined % n, combined // n
+    order = np.lexsort( (fibers, keys) )
+    return fibers[order], keys[order]
+
+def _group(fibers, keys):
+    """ The fibers and the (start, stop) range of each of their sorted keys """
+    starts = np.flatnonzero( np.diff(keys) ) + 1
+    if len(keys) > 0:
+        starts = np.concatenate( ([0], starts) )
+    keys = keys[starts]
+    stops = np.append(starts[1:], len(fibers)).tolist()
+    return fibers, dict( zip(keys.tolist(), zip(starts.tolist(), stops)) )
@@ -0,0 +1,174 @@
+""" Per-fiber metrics of a tractography computed on its packed points
+
+The metrics are computed for all fibers at once with cumulative sums,
+bincounts and shifted differences over the PackedFibers points, in chunks of fibers to
+bound the memory of the float64 intermediates. Each metric is computed
+once per FiberMetrics object, see CTrack.metrics.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+import numpy as np
+
+# number of points processed at once
+CHUNK_POINTS = 1000000
+
+class FiberMetrics(object):
+    """ Memoized metrics of the fibers of a track
+
+    Fibers without points have NaN metrics, a length of zero if they have
+    a single point.
+
+    Parameters
+    ----------
+    fibers : PackedFibers
+        the fibers of the track
+    """
+
+    def __init__(self, fibers):
+        self.fibers = fibers
+        self._cache = {}
+
+    def _memoize(self, key, fun):
+        if not key in self._cache:
+            self._cache[key] = fun()
+        return self._cache[key]
+
+    def _chunks(self):
+        """ Contiguous slices of fibers with about CHUNK_POINTS points """
+        offsets = self.fibers.offsets
+        starts = np.searchsorted(offsets, np.arange(0, offsets[-1], CHUNK_POINTS), 'right') - 1
+        bounds = np.unique( np.concatenate( (starts, [len(self.fibers)]) ) )
+        if bounds[0] != 0:
+            bounds = np.concatenate( ([0], bounds) )
+        return [ self.fibers[a:b] for a, b in zip(bounds[:-1], bounds[1:]) ]
+
+    def _per_fiber(self, fun):
+        """ Concatenates fun(points, first, last) over the chunks of fibers
+
+        first and last are the row of the first and last point of each
+        fiber of the chunk in its float64 points, last < first for empty
+        fibers.
+        """
+        res = [ fun(f.points.astype(np.float64), f.offsets[:-1], f.offsets[1:] - 1)
+                for f in self._chunks() ]
+        if len(res) == 0:
+            return fun(np.zeros( (0, 3) ), np.zeros(0, np.int64), np.zeros(0, np.int64))
+        return np.concatenate(res)
+
+    def endpoints(self):
+        """ (n, 2, 3) array of the first and last point of each fiber """
+        def compute():
+            def ends(x, first, last):
+                e = np.nan * np.ones( (len(first), 2, 3) )
+                valid = last >= first
+                e[valid, 0] = x[first[valid]]
+                e[valid, 1] = x[last[valid]]
+                return e
+            return self._per_fiber(ends)
+        return self._memoize('endpoints', compute)
+
+    def length(self):
+        """ Sum of the lengths of the segments of each fiber """
+        def compute():
+            def length(x, first, last):
+                cs = _arc_length(x, first)
+                return _ends_value(first, last, lambda f, l : cs[l] - cs[f])
+            return self._per_fiber(length)
+        return self._memoize('length', compute)
+
+    def start_end_distance(self):
+        """ Euclidean distance between the first and last point of each fiber """
+        def compute():
+            e = self.endpoints()
+            return np.sqrt( np.sum( (e[:,0] - e[:,1]) ** 2, axis = 1 ) )
+        return self._memoize('start_end_distance', compute)
+
+    def mean_curvature(self):
+        """ Mean curvature of each fiber
+
+        As dipy.tracking.metrics.mean_curvature, the mean over the points
+        of |x' x x''| / |x'|^3, with the derivatives taken by np.gradient
+        along each fiber. NaN for fibers with less than two points.
+        """
+        def compute():
+            def curvature(x, first, last):
+                d = _gradient(x, first, last)
+                dd = _gradient(d, first, last)
+                err = np.seterr(divide = 'ignore', invalid = 'ignore')
+                try:
+                    k = np.sqrt( np.sum( np.cross(d, dd) ** 2, axis = 1 ) ) / \
+                        np.sqrt( np.sum(d ** 2, axis = 1) ) ** 3
+                    # sums by fiber, such that NaN stay within their fiber
+                    n = np.maximum(last - first + 1, 0)
+                    mean = np.bincount(np.repeat(np.arange(len(n)), n), weights = k,
+                                       minlength = len(n)).astype(np.float64) / n
+                    mean[n < 2] = np.nan
+                    return mean
+                finally:
+                    np.seterr(**err)
+            return self._per_fiber(curvature)
+        return self._memoize('mean_curvature', compute)
+
+    def angle(self):
+        """ Angle in degrees at the midpoint of each fiber
+
+        The angle between the directions from the point halfway along
+        the fiber to its two endpoints, i.e. the angle of the fiber
+        downsampled to three points by dipy.tracking.metrics.downsample.
+        NaN for fibers with less than two points or no length.
+        """
+        def compute():
+            def angle(x, first, last):
+                cs = _arc_length(x, first)
+                def mid_angle(f, l):
+                    half = cs[f] + (cs[l] - cs[f]) / 2.
+                    # the segment j-1, j holding the midpoint
+                    j = np.clip(np.searchsorted(cs, half, 'right'), f + 1, l)
+                    seg = cs[j] - cs[j-1]
+                    err = np.seterr(divide = 'ignore', invalid = 'ignore')
+                    try:
+                        t = np.where(seg > 0, (half - cs[j-1]) / seg, 0.)
+                        mid = x[j-1] + t[:,None] * (x[j] - x[j-1])
+                        u = x[f] - mid
+                        v = x[l] - mid
+                        cos = np.sum(u * v, axis = 1) / np.sqrt(np.sum(u ** 2, axis = 1)) \
+                            / np.sqrt(np.sum(v ** 2, axis = 1))
+                        # rounding errors of straight fibers
+                        return np.rad2deg(np.arccos(np.clip(cos, -1, 1)))
+                    finally:
+                        np.seterr(**err)
+                return _ends_value(first, last, mid_angle, min_points = 2)
+            return self._per_fiber(angle)
+        return self._memoize('angle', compute)
+
+def _arc_length(x, first):
+    """ Cumulative length along the points, restarting at each fiber """
+    seg = np.zeros(len(x))
+    if len(x) > 1:
+        seg[1:] = np.sqrt( np.sum( np.diff(x, axis = 0) ** 2, axis = 1 ) )
+    # no segment between the last point of a fiber and the next fiber
+    seg[first[first < len(x)]] = 0
+    return np.cumsum(seg)
+
+def _ends_value(first, last, fun, min_points = 1):
+    """ fun(first, last) for the fibers with at least min_points points, NaN else """
+    res = np.nan * np.ones(len(first))
+    valid = last - first + 1 >= min_points
+    if np.any(valid):
+        res[valid] = fun(first[valid], last[valid])
+    return res
+
+def _gradient(x, first, last):
+    """ np.gradient along axis 0 of each fiber of the packed points x """
+    g = np.empty_like(x)
+    g[1:-1] = (x[2:] - x[:-2]) / 2.
+    # one-sided differences at the ends of fibers with two points or more
+    multi = last > first
+    f, l = first[multi], last[multi]
+    g[f] = x[f + 1] - x[f]
+    g[l] = x[l] - x[l - 1]
+    g[ first[last == first] ] = np.nan
+    return g
@@ -0,0 +1,342 @@
+""" On-disk cache of loaded connectome networks
+
+Parsing large GraphML files takes long. The first load of a network file
+stores the nodes, edges and their attributes as compressed NumPy arrays
+in the cache directory, keyed by a hash of the file content. Later loads
+of the same content rebuild the graph from these arrays.
+
+The cache files hold no pickles: attribute values other than numbers,
+booleans and strings are stored as JSON, tagging tuples and dictionaries
+such that they are restored, and numpy scalars become Python numbers.
+Graphs with other values are not cached. The default cache directory is
+private to the user, as the files are trusted on load.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+# Standard library imports
+import os
+import os.path as op
+import hashlib
+import json
+import tempfile
+from zipfile import ZipFile
+
+import numpy as np
+import networkx as nx
+from cfflib.util import load_data
+
+# Logging import
+import logging
+logger = logging.getLogger('root.'+__name__)
+
+# file formats of cfflib networks which are cached
+FORMATS = ('GraphML', 'NXGPickle')
+
+# version of the layout of the cache files, part of the key
+CACHE_VERSION = 2
+
+# default size limit of the cache directory in bytes
+DEFAULT_MAX_SIZE = 500 * 1024 ** 2
+
+_GRAPH_CLASSES = {'Graph' : nx.Graph, 'DiGraph' : nx.DiGraph,
+                  'MultiGraph' : nx.MultiGraph, 'MultiDiGraph' : nx.MultiDiGraph}
+
+class NetworkCache(object):
+    """ A size-bounded directory of cached networks
+
+    Parameters
+    ----------
+    directory : string, optional
+        the cache directory, created if needed, readable by the user
+        only. ~/.cviewer/network_cache if None.
+    max_size : integer, optional
+        size limit of the cache files in bytes. The least recently used
+        files are removed when it is exceeded.
+    """
+
+    def __init__(self, directory = None, max_size = DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = op.join(op.expanduser('~'), '.cviewer', 'network_cache')
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, fileobj, fileformat):
+        """ The cache key of the network in an open file """
+        h = hashlib.sha1()
+        h.update('%s-%s-%s' % (CACHE_VERSION, nx.__version__, fileformat))
+        while True:
+            block = fileobj.read(1024 ** 2)
+            if not block:
+                break
+            h.update(block)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return op.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """ The cached graph of a key, None if it is not cached """
+        path = self._path(key)
+        if not op.exists(path):
+            return None
+        try:
+            f = np.load(path, allow_pickle = False)
+            try:
+                g = arrays_to_graph(f)
+            finally:
+                f.close()
+        except Exception, e:
+            logger.warning('Ignoring corrupt network cache file %s: %s' % (path, e))
+            return None
+        # mark as recently used
+        os.utime(path, None)
+        return g
+
+    def put(self, key, g):
+        """ Stores a graph, then evicts old files above the size limit """
+        arrays = graph_to_arrays(g)
+        if not op.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+        # write to a temporary file first, such that concurrent loads
+        # never see a partial file
+        fd, tmpname = tempfile.mkstemp(suffix = '.tmp', dir = self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            np.savez_compressed(f, **arrays)
+        finally:
+            f.close()
+        path = self._path(key)
+        try:
+            # rename does not replace an existing file on Windows
+            if os.name == 'nt' and op.exists(path):
+                os.remove(path)
+            os.rename(tmpname, path)
+        except OSError:
+            os.remove(tmpname)
+            # another session stored the same network meanwhile
+            if not op.exists(path):
+                raise
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used files above the size limit """
+        files = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npz'):
+                path = op.join(self.directory, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append( (st.st_mtime, st.st_size, path) )
+        total = sum( f[1] for f in files )
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.debug('Evicted %s from the network cache' % path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """ Removes all cached networks """
+        if op.isdir(self.directory):
+            for fname in os.listdir(self.directory):
+                if fname.endswith('.npz'):
+                    os.remove(op.join(self.directory, fname))
+
+    def load_network(self, obj):
+        """ Loads a cfflib CNetwork through the cache
+
+        Can be given as custom_loader to obj.load().
+        """
+        if not obj.fileformat in FORMATS:
+            return load_data(obj)
+
+        f, zf = _open_source(obj)
+        try:
+            key = self.key(f, obj.fileformat)
+        finally:
+            f.close()
+            if not zf is None:
+                zf.close()
+
+        g = self.get(key)
+        if g is None:
+            g = load_data(obj)
+            try:
+                self.put(key, g)
+            except (IOError, OSError), e:
+                logger.warning('Can not write to the network cache: %s' % e)
+            except (TypeError, ValueError), e:
+                # e.g. attribute values which can not be stored as JSON
+                logger.info('Not caching network %s: %s' % (obj.name, e))
+        else:
+            # obj.save() writes to obj.tmpsrc, which load_data would set
+            _set_tmpsrc(obj)
+            logger.info('Loaded network %s from the cache' % obj.name)
+        return g
+
+def _open_source(obj):
+    """ Opens the source file of a cfflib object, as cfflib.util.load_data
+
+    Returns the file and the zip file it belongs to, if any.
+    """
+    if obj.parent_cfile.iszip:
+        zf = ZipFile(obj.parent_cfile.src, 'r')
+        return zf.open(obj.src), zf
+    elif hasattr(obj, 'tmpsrc'):
+        return open(obj.tmpsrc, 'rb'), None
+    else:
+        return open(op.join(op.dirname(obj.parent_cfile.fname), obj.src), 'rb'), None
+
+def _set_tmpsrc(obj):
+    """ Sets the source path of a cfflib object, as cfflib.util.load_data
+
+    Networks of a zipped connectome file are extracted to the temporary
+    folder used by load_data, without being parsed.
+    """
+    if obj.parent_cfile.iszip:
+        tmpdir = op.join(tempfile.gettempdir(), obj.parent_cfile.get_unique_cff_name())
+        zf = ZipFile(obj.parent_cfile.src, 'r')
+        try:
+            obj.tmpsrc = zf.extract(obj.src, tmpdir)
+        finally:
+            zf.close()
+    elif not hasattr(obj, 'tmpsrc'):
+        obj.tmpsrc = op.join(op.dirname(obj.parent_cfile.fname), obj.src)
+
+def graph_to_arrays(g):
+    """ The arrays storing a NetworkX graph, see arrays_to_graph
+
+    Raises TypeError or ValueError if an attribute value can not be
+    stored as JSON.
+    """
+    nodes = g.nodes()
+    index = dict( (n, i) for i, n in enumerate(nodes) )
+    if g.is_multigraph():
+        edges = g.edges(data = True, keys = True)
+    else:
+        edges = [ (u, v, None, d) for u, v, d in g.edges_iter(data = True) ]
+
+    arrays = {}
+    arrays['graph_class'] = np.array(type(g).__name__)
+    arrays['graph_attr'] = _json_array( [g.graph] )
+    arrays['nodes'], mask = _encode(nodes)
+    arrays['src'] = np.array( [ index[e[0]] for e in edges ], dtype = np.int64 )
+    arrays['dst'] = np.array( [ index[e[1]] for e in edges ], dtype = np.int64 )
+    if g.is_multigraph():
+        arrays['keys'], mask = _encode( [ e[2] for e in edges ] )
+
+    for prefix, dicts in ( ('n', [ g.node[n] for n in nodes ]), ('e', [ e[3] for e in edges ]) ):
+        attr = sorted( set( k for d in dicts for k in d ) )
+        arrays[prefix + 'attr'] = _json_array(attr)
+        for i, k in enumerate(attr):
+            values, mask = _encode( [ d.get(k) for d in dicts ], [ k in d for d in dicts ] )
+            arrays['%s%d' % (prefix, i)] = values
+            if not mask is None:
+                arrays['%smask%d' % (prefix, i)] = mask
+    return arrays
+
+def arrays_to_graph(arrays):
+    """ The NetworkX graph stored by graph_to_arrays """
+    g = _GRAPH_CLASSES[str(arrays['graph_class'])]()
+    g.graph.update(_decode(arrays['graph_attr'])[0])
+    nodes = _decode(arrays['nodes'])
+    src = arrays['src']
+    dst = arrays['dst']
+
+    dicts = {}
+    for prefix, n in ( ('n', len(nodes)), ('e', len(src)) ):
+        dicts[prefix] = [ {} for i in xrange(n) ]
+        for i, k in enumerate(_decode(arrays[prefix + 'attr'])):
+            values = _decode(arrays['%s%d' % (prefix, i)])
+            if '%smask%d' % (prefix, i) in arrays:
+                mask = arrays['%smask%d' % (prefix, i)]
+                for j in np.nonzero(mask)[0]:
+                    dicts[prefix][j][k] = values[j]
+            else:
+                for d, v in zip(dicts[prefix], values):
+                    d[k] = v
+
+    g.add_nodes_from( zip(nodes, dicts['n']) )
+    u = [ nodes[i] for i in src ]
+    v = [ nodes[i] for i in dst ]
+    if g.is_multigraph():
+        g.add_edges_from( zip(u, v, _decode(arrays['keys']), dicts['e']) )
+    else:
+        g.add_edges_from( zip(u, v, dicts['e']) )
+    return g
+
+def _encode(values, present = None):
+    """ A typed array of attribute values, and the mask of the present ones
+
+    Numbers, booleans and strings are stored natively, other values as
+    JSON, see _json_array. The mask is None if all values are present.
+    """
+    if present is None or all(present):
+        mask = None
+        stored = values
+    else:
+        mask = np.array(present, dtype = bool)
+        stored = [ v for v, p in zip(values, present) if p ]
+
+    types = set( type(v) for v in stored )
+    if types == set([bool]):
+        dtype = bool
+    elif types and types <= set([int, long]) and \
+        all( -2**63 <= v < 2**63 for v in stored ):
+        dtype = np.int64
+    elif types == set([float]):
+        dtype = np.float64
+    elif types == set([str]) or types == set([unicode]):
+        dtype = None
+    else:
+        return _json_array( [ v if p else None for v, p in
+                              zip(values, present or [True] * len(values)) ] ), mask
+
+    if mask is None:
+        return np.array(values, dtype = dtype), mask
+    # fill the missing values with any present one
+    fill = stored[0]
+    return np.array( [ v if p else fill for v, p in zip(values, present) ], dtype = dtype ), mask
+
+def _json_array(values):
+    """ A structured array of the JSON texts of values, see _decode """
+    texts = [ json.dumps(_tag(v)) for v in values ]
+    return np.array( texts, dtype = [ ('json', 'S%d' % max( [1] + map(len, texts) )) ] )
+
+def _decode(a):
+    """ The list of values stored by _encode or _json_array """
+    if a.dtype.names == ('json',):
+        return [ _untag(json.loads(t)) for t in a['json'] ]
+    return a.tolist()
+
+def _tag(v):
+    """ v with tuples and dictionaries tagged, which JSON does not keep """
+    if v is None or isinstance(v, (bool, int, long, float, basestring)):
+        return v
+    if isinstance(v, np.generic) and v.dtype.kind in 'biuf':
+        return v.item()
+    if isinstance(v, list):
+        return [ _tag(x) for x in v ]
+    if isinstance(v, tuple):
+        return { 't' : [ _tag(x) for x in v ] }
+    if isinstance(v, dict):
+        return { 'd' : [ [ _tag(k), _tag(x) ] for k, x in v.iteritems() ] }
+    raise TypeError('Can not store a %s attribute value' % type(v).__name__)
+
+def _untag(v):
+    """ The value tagged by _tag """
+    if isinstance(v, list):
+        return [ _untag(x) for x in v ]
+    if isinstance(v, dict):
+        if 't' in v:
+            return tuple( _untag(x) for x in v['t'] )
+        return dict( (_untag(k), _untag(x)) for k, x in v['d'] )
+    return v
@@ -0,0 +1,307 @@
+""" Streaming export of connectome networks to GEXF and GraphML
+
+The XML is written in chunks of nodes and edges directly from the
+NetworkColumns of a network, converting each attribute column to text
+at once. Unlike nx.write_gexf and nx.write_graphml, no XML tree of the
+whole network is built and the graph data are not modified, e.g. NumPy
+floats need not be converted to Python floats first.
+
+Missing values, None in object columns, NaN in float columns and the
+values outside of the mask of integer columns, are not written.
+
+The graph attributes are written as GraphML data of the graph, as by
+nx.write_graphml. GEXF has no graph attributes: as nx.write_gexf, only
+the meta data 'creator', 'keywords' and 'description' of the graph
+attributes are written, to the meta element, and the others are left out.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+# number of nodes or edges converted and written at once
+DEFAULT_CHUNK_SIZE = 10000
+
+# characters escaped in attribute values
+_ENTITIES = {'"' : '&quot;', '\n' : '&#10;', '\r' : '&#13;', '\t' : '&#9;'}
+
+_GEXF_HEADER = u"""<?xml version="1.0" encoding="utf-8"?>
+<gexf xmlns="http://www.gexf.net/1.2draft" \
+xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" \
+xsi:schemaLocation="http://www.gexf.net/1.2draft http://www.gexf.net/1.2draft/gexf.xsd" \
+version="1.2">
+"""
+
+# graph attributes written to the GEXF meta element
+_GEXF_META = ('creator', 'keywords', 'description')
+
+_GRAPHML_HEADER = u"""<?xml version="1.0" encoding="utf-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns" \
+xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" \
+xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns \
+http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">
+"""
+
+def write_gexf(columns, f, chunk_size = DEFAULT_CHUNK_SIZE):
+    """ Writes a network in the GEXF format, readable by Gephi
+
+    As nx.write_gexf, the node attribute 'label' gives the node labels,
+    and a numerical edge attribute 'weight' the edge weights.
+
+    Parameters
+    ----------
+    columns : NetworkColumns
+        the nodes and edges of the network
+    f : string or file
+        file name or file open for writing
+    chunk_size : integer, optional
+        number of nodes or edges converted to text at once
+    """
+    nattr = _attributes(columns.node, columns.node_mask, ('label',))
+    weight = columns.edge.get('weight')
+    if weight is None or not _kind(weight) in ('long', 'double'):
+        weight = None
+    else:
+        weight_mask = columns.edge_mask.get('weight')
+    eattr = _attributes(columns.edge, columns.edge_mask,
+                        ('weight',) if not weight is None else ())
+
+    f, close = _open(f)
+    try:
+        write = lambda lines : f.write( u''.join(lines).encode('utf-8') )
+        lines = [ _GEXF_HEADER ]
+        meta = [ k for k in _GEXF_META if columns.graph.get(k) is not None ]
+        if meta:
+            lines.append( u'  <meta>\n' )
+            for k in meta:
+                lines.append( u'    <%s>%s</%s>\n' % (k, _escape(columns.graph[k]), k) )
+            lines.append( u'  </meta>\n' )
+        lines.append( u'  <graph defaultedgetype="%s" mode="static">\n' %
+                      ('directed' if columns.directed else 'undirected') )
+        write(lines)
+        for cls, attr in ( ('node', nattr), ('edge', eattr) ):
+            if attr:
+                lines = [ u'    <attributes class="%s" mode="static">\n' % cls ]
+                for i, (key, col, kind, mask) in enumerate(attr):
+                    lines.append( u'      <attribute id="%d" title="%s" type="%s" />\n' %
+                                  (i, _escape(key), 'string' if kind == 'vector' else kind) )
+                lines.append( u'    </attributes>\n' )
+                write(lines)
+
+        ids = _text(columns.nodes, 'string', slice(None))
+        write( [ u'    <nodes>\n' ] )
+        for sl in _chunks(len(ids), chunk_size):
+            if 'label' in columns.node:
+                labels = [ i if l is None else l for i, l in
+                           zip(ids[sl], _text(columns.node['label'], 'string', sl)) ]
+            else:
+                labels = ids[sl]
+            values = _attribute_text(nattr, sl)
+            lines = []
+            for r, (nid, label) in enumerate(zip(ids[sl], labels)):
+                lines.append( u'      <node id="%s" label="%s">\n' % (nid, label) )
+                _gexf_attvalues(lines, values, r)
+                lines.append( u'      </node>\n' )
+            write(lines)
+        write( [ u'    </nodes>\n    <edges>\n' ] )
+
+        for sl in _chunks(len(columns), chunk_size):
+            src = [ ids[i] for i in columns.src[sl].tolist() ]
+            dst = [ ids[i] for i in columns.dst[sl].tolist() ]
+            if weight is None:
+                weights = [ None ] * len(src)
+            else:
+                weights = _text(weight, _kind(weight), sl, weight_mask)
+            values = _attribute_text(eattr, sl)
+            lines = []
+            for r, eid in enumerate( xrange(sl.start, sl.stop) ):
+                if weights[r] is None:
+                    lines.append( u'      <edge id="%d" source="%s" target="%s">\n' %
+                                  (eid, src[r], dst[r]) )
+                else:
+                    lines.append( u'      <edge id="%d" source="%s" target="%s" weight="%s">\n' %
+                                  (eid, src[r], dst[r], weights[r]) )
+                _gexf_attvalues(lines, values, r)
+                lines.append( u'      </edge>\n' )
+            write(lines)
+        write( [ u'    </edges>\n  </graph>\n</gexf>\n' ] )
+    finally:
+        if close:
+            f.close()
+
+def write_graphml(columns, f, chunk_size = DEFAULT_CHUNK_SIZE):
+    """ Writes a network in the GraphML format
+
+    Parameters
+    ----------
+    columns : NetworkColumns
+        the nodes and edges of the network
+    f : string or file
+        file name or file open for writing
+    chunk_size : integer, optional
+        number of nodes or edges converted to text at once
+    """
+    nattr = _attributes(columns.node, columns.node_mask)
+    eattr = _attributes(columns.edge, columns.edge_mask)
+    # as nx.write_graphml, the id is an attribute of the graph element
+    gattr = [ (k, v, _value_kind(v)) for k, v in sorted(columns.graph.items())
+              if not k in ('id', 'node_default', 'edge_default') and not v is None ]
+
+    f, close = _open(f)
+    try:
+        write = lambda lines : f.write( u''.join(lines).encode('utf-8') )
+        lines = [ _GRAPHML_HEADER ]
+        gkeys = []
+        nkeys = []
+        ekeys = []
+        for key, value, kind in gattr:
+            gkeys.append( 'd%d' % len(gkeys) )
+            lines.append( u'  <key attr.name="%s" attr.type="%s" for="graph" id="%s" />\n' %
+                          (_escape(key), kind, gkeys[-1]) )
+        for cls, attr, keys in ( ('node', nattr, nkeys), ('edge', eattr, ekeys) ):
+            for key, col, kind, mask in attr:
+                keys.append( 'd%d' % (len(gkeys) + len(nkeys) + len(ekeys)) )
+                lines.append( u'  <key attr.name="%s" attr.type="%s" for="%s" id="%s" />\n' %
+                              (_escape(key), 'string' if kind == 'vector' else kind,
+                               cls, keys[-1]) )
+        graphid = columns.graph.get('id')
+        if graphid is None:
+            lines.append( u'  <graph edgedefault="%s">\n' %
+                          ('directed' if columns.directed else 'undirected') )
+        else:
+            lines.append( u'  <graph edgedefault="%s" id="%s">\n' %
+                          ('directed' if columns.directed else 'undirected', _escape(graphid)) )
+        for gkey, (key, value, kind) in zip(gkeys, gattr):
+            lines.append( u'    <data key="%s">%s</data>\n' % (gkey, _value_text(value, kind)) )
+        write(lines)
+
+        ids = _text(columns.nodes, 'string', slice(None))
+        for sl in _chunks(len(ids), chunk_size):
+            values = _attribute_text(nattr, sl)
+            lines = []
+            for r, nid in enumerate(ids[sl]):
+                lines.append( u'    <node id="%s">\n' % nid )
+                _graphml_data(lines, nkeys, values, r)
+                lines.append( u'    </node>\n' )
+            write(lines)
+
+        for sl in _chunks(len(columns), chunk_size):
+            src = [ ids[i] for i in columns.src[sl].tolist() ]
+            dst = [ ids[i] for i in columns.dst[sl].tolist() ]
+            values = _attribute_text(eattr, sl)
+            lines = []
+            for r in xrange(len(src)):
+                lines.append( u'    <edge source="%s" target="%s">\n' % (src[r], dst[r]) )
+                _graphml_data(lines, ekeys, values, r)
+                lines.append( u'    </edge>\n' )
+            write(lines)
+        write( [ u'  </graph>\n</graphml>\n' ] )
+    finally:
+        if close:
+            f.close()
+
+def _gexf_attvalues(lines, values, r):
+    """ Appends the attvalues element of row r, if it has any value """
+    att = [ u'          <attvalue for="%d" value="%s" />\n' % (i, text[r])
+            for i, text in enumerate(values) if not text[r] is None ]
+    if att:
+        lines.append( u'        <attvalues>\n' )
+        lines.extend(att)
+        lines.append( u'        </attvalues>\n' )
+
+def _graphml_data(lines, keys, values, r):
+    """ Appends the data elements of row r """
+    for key, text in zip(keys, values):
+        if not text[r] is None:
+            lines.append( u'      <data key="%s">%s</data>\n' % (key, text[r]) )
+
+def _open(f):
+    """ The file to write to, and whether it has to be closed """
+    if isinstance(f, basestring):
+        return open(f, 'wb'), True
+    return f, False
+
+def _chunks(n, chunk_size):
+    """ Slices of at most chunk_size rows covering n rows """
+    chunk_size = max(chunk_size, 1)
+    return [ slice(start, min(start + chunk_size, n)) for start in xrange(0, n, chunk_size) ]
+
+def _attributes(table, masks, exclude = ()):
+    """ (key, column, kind, mask) of the attribute columns, sorted by key
+
+    mask is the mask of the present values of an integer column, or None.
+    """
+    return [ (k, table[k], _kind(table[k]), masks.get(k)) for k in sorted(table)
+             if not k in exclude ]
+
+def _kind(col):
+    """ The XML type of a column: long, double, boolean, string or vector """
+    if col.dtype.kind in 'iu':
+        return 'long'
+    if col.dtype.kind == 'f':
+        if col.ndim == 1:
+            return 'double'
+        return 'vector'
+    present = [ v for v in col if not v is None ]
+    if present and all( isinstance(v, (bool, np.bool_)) for v in present ):
+        return 'boolean'
+    return 'string'
+
+def _value_kind(value):
+    """ The XML type of a single value: long, double, boolean or string """
+    if isinstance(value, (bool, np.bool_)):
+        return 'boolean'
+    if isinstance(value, (int, long, np.integer)):
+        return 'long'
+    if isinstance(value, (float, np.floating)):
+        return 'double'
+    return 'string'
+
+def _value_text(value, kind):
+    """ The escaped text of a single value """
+    if kind == 'boolean':
+        return u'true' if value else u'false'
+    if kind == 'double':
+        return repr(float(value))
+    return _escape(value)
+
+def _attribute_text(attr, sl):
+    return [ _text(col, kind, sl, mask) for key, col, kind, mask in attr ]
+
+def _text(col, kind, sl, mask = None):
+    """ The escaped text of the values col[sl], None for missing values
+
+    Numerical columns are converted to Python numbers at once. mask is
+    the mask of the present values of an integer column.
+    """
+    part = col[sl]
+    if kind == 'long':
+        text = map(unicode, part.tolist())
+        if not mask is None:
+            for i in np.flatnonzero(~mask[sl]):
+                text[i] = None
+        return text
+    if kind == 'double':
+        text = map(repr, part.tolist())
+        for i in np.flatnonzero(np.isnan(part)):
+            text[i] = None
+        return text
+    if kind == 'vector':
+        text = [ u'(%s)' % u', '.join(map(repr, row)) for row in part.tolist() ]
+        for i in np.flatnonzero(np.isnan(part).all(axis = 1)):
+            text[i] = None
+        return text
+    if kind == 'boolean':
+        return [ None if v is None else (u'true' if v else u'false') for v in part ]
+    return [ None if v is None else _escape(v) for v in part ]
+
+def _escape(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return escape(value, _ENTITIES)
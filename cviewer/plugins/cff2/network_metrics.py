@@ -0,0 +1,145 @@
+""" Graph metrics of connectome networks computed on their adjacency matrix
+
+The metrics use the sparse matrix of a network and scipy.sparse.csgraph
+instead of iterating over the NetworkX graph. Directed networks are
+treated as undirected, self-loops are ignored. Each metric is computed
+once per NetworkMetrics object, see CNetwork.metrics.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse import csgraph
+
+class NetworkMetrics(object):
+    """ Memoized graph metrics of a weighted adjacency matrix
+
+    Parameters
+    ----------
+    adjacency : ndarray or scipy.sparse matrix
+        N x N matrix of the edge weights, zero where there is no edge
+    """
+
+    def __init__(self, adjacency):
+        W = sp.csr_matrix(adjacency, dtype = np.float64)
+        # undirected, without self-loops
+        W = W.maximum(W.T).tolil()
+        W.setdiag(0)
+        W = W.tocsr()
+        W.eliminate_zeros()
+        self.W = W
+        self.A = W.copy()
+        self.A.data[:] = 1
+        self._cache = {}
+
+    def _memoize(self, key, fun):
+        if not key in self._cache:
+            self._cache[key] = fun()
+        return self._cache[key]
+
+    def number_of_nodes(self):
+        return self.W.shape[0]
+
+    def number_of_edges(self):
+        return self.A.nnz // 2
+
+    def degree(self):
+        """ Number of neighbors of each node """
+        return self._memoize('degree', lambda : np.diff(self.A.indptr))
+
+    def strength(self):
+        """ Sum of the edge weights of each node """
+        return self._memoize('strength', lambda : np.asarray(self.W.sum(axis = 1)).ravel())
+
+    def clustering(self, weighted = False):
+        """ Clustering coefficient of each node
+
+        The fraction of the pairs of neighbors which are connected, zero
+        for nodes with less than two neighbors. If weighted, the geometric
+        mean of the normalized weights of each triangle is used instead,
+        as in NetworkX (Onnela et al., 2005).
+        """
+        def compute():
+            if weighted:
+                M = self.W.copy()
+                if M.nnz > 0:
+                    M.data = (M.data / M.data.max()) ** (1 / 3.)
+            else:
+                M = self.A
+            # closed walks of length three through each node
+            triangles = np.asarray( M.dot(M).multiply(M).sum(axis = 1) ).ravel()
+            k = self.degree().astype(np.float64)
+            c = np.zeros(len(k))
+            valid = k > 1
+            c[valid] = triangles[valid] / (k[valid] * (k[valid] - 1))
+            return c
+        return self._memoize(('clustering', weighted), compute)
+
+    def average_clustering(self, weighted = False):
+        """ Mean clustering coefficient over all nodes """
+        return np.mean(self.clustering(weighted))
+
+    def components(self):
+        """ Number of connected components and the component of each node """
+        return self._memoize('components',
+                             lambda : csgraph.connected_components(self.A, directed = False))
+
+    def number_of_components(self):
+        return self.components()[0]
+
+    def distances(self, weighted = False):
+        """ N x N matrix of the shortest path lengths
+
+        Unweighted, the length is the number of edges. Weighted, the
+        length of an edge is the inverse of its weight. Disconnected
+        pairs have an infinite distance.
+        """
+        def compute():
+            if weighted:
+                L = self.W.copy()
+                L.data = 1. / L.data
+                return csgraph.shortest_path(L, directed = False)
+            return csgraph.shortest_path(self.A, directed = False, unweighted = True)
+        return self._memoize(('distances', weighted), compute)
+
+    def _offdiagonal_distances(self, weighted):
+        D = self.distances(weighted)
+        return D[~np.eye(len(D), dtype = bool)]
+
+    def characteristic_path_length(self, weighted = False):
+        """ Mean shortest path length over the connected pairs of nodes
+
+        For a connected network, this is the average shortest path length
+        of NetworkX.
+        """
+        def compute():
+            d = self._offdiagonal_distances(weighted)
+            d = d[np.isfinite(d)]
+            if len(d) == 0:
+                return 0.
+            return np.mean(d)
+        return self._memoize(('path_length', weighted), compute)
+
+    def global_efficiency(self, weighted = False):
+        """ Mean inverse shortest path length over all pairs of nodes """
+        def compute():
+            d = self._offdiagonal_distances(weighted)
+            if len(d) == 0:
+                return 0.
+            return np.mean(1. / d)
+        return self._memoize(('efficiency', weighted), compute)
+
+    def local_efficiency(self):
+        """ Global efficiency of the subgraph of the neighbors of each node """
+        def compute():
+            A = self.A
+            e = np.zeros(self.number_of_nodes())
+            for i in range(len(e)):
+                nb = A.indices[A.indptr[i]:A.indptr[i+1]]
+                if len(nb) > 1:
+                    e[i] = NetworkMetrics(A[nb][:, nb]).global_efficiency()
+            return e
+        return self._memoize('local_efficiency', compute)
@@ -0,0 +1,109 @@
+""" Packed storage of the fibers of a tractography
+
+The points of all fibers are stored in one contiguous (P, 3) float32
+array, fiber i being the rows offsets[i]:offsets[i+1]. Compared to a list
+or object array of small arrays, this has no per-fiber overhead and lets
+per-fiber quantities be computed with vectorized operations over all
+points, e.g. np.add.reduceat(values, offsets[:-1]).
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+import numpy as np
+
+class PackedFibers(object):
+    """ Fibers as a flat array of points and the offsets of each fiber
+
+    Parameters
+    ----------
+    points : (P, 3) array
+        the points of all fibers, one after the other
+    offsets : (n + 1,) integer array
+        fiber i is points[offsets[i]:offsets[i+1]], offsets[0] is zero
+        and offsets[-1] is P
+    """
+
+    def __init__(self, points, offsets):
+        self.points = np.asarray(points)
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        if self.points.ndim != 2 or self.points.shape[1] != 3:
+            raise ValueError('The points must be a (P, 3) array')
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or \
+           self.offsets[-1] != len(self.points):
+            raise ValueError('The offsets must start at 0 and end at the number of points')
+
+    @classmethod
+    def from_fibers(cls, fibers):
+        """ Packs a list or object array of (n_i, 3) arrays """
+        offsets = _offsets( [ len(f) for f in fibers ] )
+        points = np.empty( (offsets[-1], 3), dtype = np.float32 )
+        for i, f in enumerate(fibers):
+            points[offsets[i]:offsets[i+1]] = f
+        return cls(points, offsets)
+
+    def to_object_array(self):
+        """ The fibers as an object array of views of the points """
+        fibers = np.empty(len(self), dtype = object)
+        for i in xrange(len(self)):
+            fibers[i] = self.fiber(i)
+        return fibers
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """ Number of points of each fiber """
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.points.nbytes + self.offsets.nbytes
+
+    def fiber(self, i):
+        """ The points of fiber i, a view """
+        if i < 0:
+            i += len(self)
+        return self.points[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.fiber(i)
+
+    def __getitem__(self, key):
+        """ A fiber, or the PackedFibers of a subset of fibers
+
+        Contiguous slices share the memory of the points, other slices,
+        integer arrays and boolean masks copy the selected points.
+        """
+        if isinstance(key, (int, long, np.integer)):
+            return self.fiber(key)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                offsets = self.offsets[start:stop+1]
+                return PackedFibers(self.points[offsets[0]:offsets[-1]], offsets - offsets[0])
+        indices = np.arange(len(self))[key]
+        return PackedFibers(self.points[self.point_index(indices)],
+                            _offsets(self.lengths[indices]))
+
+    def point_index(self, indices):
+        """ The rows of the points of the given fibers, in this order """
+        lengths = self.lengths[indices]
+        offsets = _offsets(lengths)
+        # the first point of each fiber, shifted by the preceding points
+        return np.repeat(self.offsets[indices] - offsets[:-1], lengths) + \
+            np.arange(offsets[-1])
+
+    def fiber_index(self):
+        """ The fiber of each point """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+def _offsets(lengths):
+    """ The offsets of fibers of the given lengths """
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    np.cumsum(lengths, out = offsets[1:])
+    return offsets
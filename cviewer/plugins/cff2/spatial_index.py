@@ -0,0 +1,275 @@
+""" Spatial index of the fibers of a track for region of interest queries
+
+A uniform grid of cubic cells maps each cell to the fibers having a point
+in it, stored in CSR form: the sorted ids of the non-empty cells, the
+offsets of their fibers and the fibers. Queries for the fibers passing
+through a sphere or a box take the fibers of the cells overlapping it as
+candidates, then test only the points of these candidates exactly.
+A KD-tree over the endpoints answers queries on the fiber endpoints.
+
+The grid covers the volume of the track, points outside of it are
+assigned to the closest border cell. The index is saved as a .npz file
+in the spatial index directory, see CTrack.spatial_index.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+# Standard library imports
+import os
+import tempfile
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Logging import
+import logging
+logger = logging.getLogger('root.'+__name__)
+
+# version of the layout of the index files
+INDEX_VERSION = 1
+
+# default edge length of the grid cells, in the units of the points (mm)
+DEFAULT_CELL_SIZE = 4.
+
+# number of fibers processed at once when building the index
+CHUNK_FIBERS = 100000
+
+class SpatialIndex(object):
+    """ Grid of the fibers in each cell and KD-tree of the fiber endpoints
+
+    Use SpatialIndex.build or SpatialIndex.load to create an index.
+
+    Parameters
+    ----------
+    fibers : callable
+        returns the PackedFibers of a slice or an array of fiber indices
+    low : (3,) array
+        lower corner of the grid
+    cell_size : float
+        edge length of the cells
+    shape : (3,) array
+        number of cells along each axis
+    cells : (m,) int64 array
+        sorted ids of the non-empty cells
+    offsets : (m + 1,) int64 array
+        the fibers of cell cells[i] are fibers[offsets[i]:offsets[i+1]]
+    cell_fibers : integer array
+        fibers of the cells
+    endpoints : (n, 2, 3) array
+        first and last point of each fiber, NaN for empty fibers
+    """
+
+    def __init__(self, fibers, low, cell_size, shape, cells, offsets, cell_fibers, endpoints):
+        self.fibers = fibers
+        self.low = np.asarray(low, dtype = np.float64)
+        self.cell_size = float(cell_size)
+        self.shape = np.asarray(shape, dtype = np.int64)
+        self.cells = cells
+        self.offsets = offsets
+        self.cell_fibers = cell_fibers
+        self.endpoints = endpoints
+        self._tree = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    @classmethod
+    def build(cls, fibers, n, low, high, cell_size = DEFAULT_CELL_SIZE):
+        """ Builds the index, reading the fibers in chunks
+
+        Parameters
+        ----------
+        fibers : callable
+            returns the PackedFibers of a slice or an array of fiber indices
+        n : integer
+            number of fibers
+        low, high : (3,) arrays
+            corners of the volume of the track
+        cell_size : float, optional
+            edge length of the grid cells
+        """
+        low = np.asarray(low, dtype = np.float64)
+        shape = np.maximum( np.ceil( (np.asarray(high) - low) / cell_size ), 1 ).astype(np.int64)
+        ncells = int(np.prod(shape))
+        # cell and fiber are combined in one key if it fits
+        combine = ncells < np.iinfo(np.int64).max // max(n, 1) - 1
+
+        keys = []
+        endpoints = np.nan * np.ones( (n, 2, 3) )
+        for start in xrange(0, n, CHUNK_FIBERS):
+            stop = min(start + CHUNK_FIBERS, n)
+            chunk = fibers( slice(start, stop) )
+            cell = _cell_ids(chunk.points, low, cell_size, shape)
+            fiber = start + chunk.fiber_index()
+            if combine:
+                keys.append( np.unique(cell * n + fiber) )
+            else:
+                keys.append( np.unique( np.vstack( (cell, fiber) ).T.copy().view('i8,i8') ) )
+            lengths = chunk.lengths
+            valid = lengths > 0
+            endpoints[start:stop][valid, 0] = chunk.points[chunk.offsets[:-1][valid]]
+            endpoints[start:stop][valid, 1] = chunk.points[chunk.offsets[1:][valid] - 1]
+
+        if len(keys) == 0:
+            cell = fiber = np.zeros(0, dtype = np.int64)
+        elif combine:
+            key = np.sort( np.concatenate(keys) )
+            cell, fiber = key // max(n, 1), key % max(n, 1)
+        else:
+            key = np.sort( np.concatenate(keys) )
+            cell, fiber = key['f0'], key['f1']
+        del keys
+
+        starts = np.flatnonzero( np.diff(cell) ) + 1
+        if len(cell) > 0:
+            starts = np.concatenate( ([0], starts) )
+        fiber_dtype = np.int32 if n < 2 ** 31 else np.int64
+        return cls(fibers, low, cell_size, shape, cell[starts],
+                   np.append(starts, len(cell)).astype(np.int64),
+                   fiber.astype(fiber_dtype), endpoints)
+
+    def save(self, fname, fingerprint = ''):
+        """ Saves the index, atomically, tagged with a fingerprint of the track
+
+        The directory of fname is created if needed, readable by the
+        user only.
+        """
+        directory = os.path.dirname(fname) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        fd, tmpname = tempfile.mkstemp(suffix = '.tmp', dir = directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            try:
+                np.savez(f, version = INDEX_VERSION, fingerprint = np.array(fingerprint),
+                         low = self.low, cell_size = self.cell_size, shape = self.shape,
+                         cells = self.cells, offsets = self.offsets,
+                         cell_fibers = self.cell_fibers, endpoints = self.endpoints)
+            finally:
+                f.close()
+            # rename does not replace an existing file on Windows
+            if os.name == 'nt' and os.path.exists(fname):
+                os.remove(fname)
+            os.rename(tmpname, fname)
+        except:
+            os.remove(tmpname)
+            raise
+
+    @classmethod
+    def load(cls, fname, fibers, fingerprint = '', cell_size = None):
+        """ Loads a saved index
+
+        Returns None if the file does not exist, or was saved for another
+        fingerprint, cell size or version.
+        """
+        if not os.path.exists(fname):
+            return None
+        try:
+            f = np.load(fname)
+            try:
+                if int(f['version']) != INDEX_VERSION or str(f['fingerprint']) != fingerprint:
+                    return None
+                if not cell_size is None and float(f['cell_size']) != cell_size:
+                    return None
+                return cls(fibers, f['low'], float(f['cell_size']), f['shape'], f['cells'],
+                           f['offsets'], f['cell_fibers'], f['endpoints'])
+            finally:
+                f.close()
+        except Exception, e:
+            logger.warning('Ignoring invalid spatial index %s: %s' % (fname, e))
+            return None
+
+    def candidates(self, low, high):
+        """ Fibers with a point in the cells overlapping the box [low, high] """
+        lo = _cell_coords(np.atleast_2d(low), self.low, self.cell_size, self.shape)[0]
+        hi = _cell_coords(np.atleast_2d(high), self.low, self.cell_size, self.shape)[0]
+        grid = np.mgrid[ lo[0]:hi[0]+1, lo[1]:hi[1]+1, lo[2]:hi[2]+1 ].reshape(3, -1)
+        ids = (grid[0] * self.shape[1] + grid[1]) * self.shape[2] + grid[2]
+        # the non-empty cells among them
+        pos = np.searchsorted(self.cells, ids)
+        found = pos < len(self.cells)
+        pos = pos[found][ self.cells[pos[found]] == ids[found] ]
+        if len(pos) == 0:
+            return np.zeros(0, dtype = np.int64)
+        parts = [ self.cell_fibers[self.offsets[p]:self.offsets[p+1]] for p in pos ]
+        return np.unique( np.concatenate(parts) ).astype(np.int64)
+
+    def _points_inside(self, candidates, inside):
+        """ The candidates having a point for which inside(points) is True """
+        if len(candidates) == 0:
+            return candidates
+        packed = self.fibers(candidates)
+        hit = inside(packed.points.astype(np.float64))
+        return candidates[ np.bincount(packed.fiber_index()[hit], minlength = len(candidates)) > 0 ]
+
+    def fibers_in_sphere(self, center, radius):
+        """ Indices of the fibers with a point in the sphere """
+        center = np.asarray(center, dtype = np.float64)
+        candidates = self.candidates(center - radius, center + radius)
+        return self._points_inside(candidates,
+            lambda p : np.sum( (p - center) ** 2, axis = 1 ) <= radius ** 2)
+
+    def fibers_in_box(self, low, high):
+        """ Indices of the fibers with a point in the box [low, high] """
+        low = np.asarray(low, dtype = np.float64)
+        high = np.asarray(high, dtype = np.float64)
+        candidates = self.candidates(low, high)
+        return self._points_inside(candidates,
+            lambda p : np.all( (p >= low) & (p <= high), axis = 1 ))
+
+    def _endpoint_tree(self):
+        """ The KD-tree of the endpoints and the fiber of each tree point
+
+        The tree is None if there are no endpoints.
+        """
+        if self._tree is None:
+            points = self.endpoints.reshape(-1, 3)
+            valid = np.flatnonzero( ~np.isnan(points[:,0]) )
+            tree = cKDTree(points[valid]) if len(valid) > 0 else None
+            self._tree = ( tree, valid // 2 )
+        return self._tree
+
+    def _endpoint_fibers(self, found, both):
+        """ The fibers with one or both endpoints among the found tree points """
+        tree, fiber = self._endpoint_tree()
+        count = np.bincount(fiber[np.asarray(found, dtype = np.int64)], minlength = len(self))
+        if both:
+            # fibers with a single point have it twice
+            return np.flatnonzero(count >= 2)
+        return np.flatnonzero(count > 0)
+
+    def endpoints_in_sphere(self, center, radius, both = False):
+        """ Indices of the fibers with an endpoint in the sphere
+
+        If both, the two endpoints must be in the sphere.
+        """
+        tree, fiber = self._endpoint_tree()
+        if tree is None:
+            return np.zeros(0, dtype = np.int64)
+        return self._endpoint_fibers(tree.query_ball_point(center, radius), both)
+
+    def endpoints_in_box(self, low, high, both = False):
+        """ Indices of the fibers with an endpoint in the box [low, high] """
+        tree, fiber = self._endpoint_tree()
+        if tree is None:
+            return np.zeros(0, dtype = np.int64)
+        low = np.asarray(low, dtype = np.float64)
+        high = np.asarray(high, dtype = np.float64)
+        # the cube around the box, then the points inside the box
+        found = np.asarray(tree.query_ball_point( (low + high) / 2., np.max(high - low) / 2.,
+                                                  p = np.inf ), dtype = np.int64)
+        p = tree.data[found]
+        found = found[ np.all( (p >= low) & (p <= high), axis = 1 ) ]
+        return self._endpoint_fibers(found, both)
+
+def _cell_coords(points, low, cell_size, shape):
+    """ Grid coordinates of the cells of points, clipped to the grid """
+    c = np.floor( (points - low) / cell_size ).astype(np.int64)
+    return np.clip(c, 0, shape - 1)
+
+def _cell_ids(points, low, cell_size, shape):
+    """ Linear ids of the cells of points """
+    c = _cell_coords(points, low, cell_size, shape)
+    return (c[:,0] * shape[1] + c[:,1]) * shape[2] + c[:,2]
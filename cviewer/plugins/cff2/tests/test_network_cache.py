@@ -0,0 +1,106 @@
+""" Tests of the network cache """
+
+import os
+import os.path as op
+import shutil
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+import numpy as np
+import networkx as nx
+import cfflib
+
+from cviewer.plugins.cff2.network_cache import NetworkCache, graph_to_arrays, \
+    arrays_to_graph
+
+class TestLoadNetwork(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        c = cfflib.connectome()
+        c.connectome_meta.set_title('cache test')
+        g = nx.Graph()
+        g.add_edge('1', '2', weight = 1.5)
+        c.add_connectome_network_from_nxgraph('net', g)
+        self.fname = op.join(self.tmpdir, 'test.cff')
+        cfflib.save_to_cff(c, self.fname)
+        self.cache = NetworkCache(op.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, fname):
+        net = cfflib.load(fname).get_connectome_network()[0]
+        net.load(custom_loader = self.cache.load_network)
+        return net
+
+    def check_load_close(self, fname):
+        # the first load fills the cache, the second one is a cache hit
+        self.load(fname)
+        net = self.load(fname)
+        self.assertEqual(len(os.listdir(self.cache.directory)), 1)
+        self.assertEqual(net.data.edges(data = True), [('1', '2', {'weight' : 1.5})])
+        # as CBase.close
+        net.save()
+        self.assertTrue(op.exists(net.tmpsrc))
+
+    def test_zipped(self):
+        self.check_load_close(self.fname)
+
+    def test_extracted(self):
+        folder = op.join(self.tmpdir, 'extracted')
+        zf = ZipFile(self.fname, 'r')
+        try:
+            zf.extractall(folder)
+        finally:
+            zf.close()
+        self.check_load_close(op.join(folder, 'meta.cml'))
+        self.assertEqual(self.load(op.join(folder, 'meta.cml')).tmpsrc,
+                         op.join(folder, 'CNetwork', 'net.gpickle'))
+
+class TestArrays(unittest.TestCase):
+
+    def test_round_trip(self):
+        g = nx.MultiDiGraph(name = 'test', info = {1 : (2, u'\xe9')})
+        g.add_node(1, dn_position = (1.5, 2.0), label = 'a')
+        g.add_node('x', dn_position = [3, None], count = 2 ** 70)
+        g.add_edge(1, 'x', key = 'k', weight = np.float64(0.5), ids = {'a' : [1, 2]})
+        g.add_edge('x', 1, weight = 2.0)
+        h = arrays_to_graph(graph_to_arrays(g))
+        self.assertEqual(h.graph, g.graph)
+        self.assertEqual(sorted(h.nodes(data = True)), sorted(g.nodes(data = True)))
+        self.assertEqual(sorted(h.edges(data = True, keys = True)),
+                         sorted(g.edges(data = True, keys = True)))
+
+    def test_no_pickles(self):
+        g = nx.Graph(info = {'a' : 1})
+        g.add_node(1, value = (1, 'b'))
+        for a in graph_to_arrays(g).values():
+            self.assertFalse(a.dtype.hasobject)
+        g.add_node(2, value = object())
+        self.assertRaises(TypeError, graph_to_arrays, g)
+
+    def test_private_directory(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            home = os.environ.get('HOME')
+            os.environ['HOME'] = tmpdir
+            try:
+                cache = NetworkCache()
+            finally:
+                if home is None:
+                    del os.environ['HOME']
+                else:
+                    os.environ['HOME'] = home
+            self.assertEqual(cache.directory, op.join(tmpdir, '.cviewer', 'network_cache'))
+            cache.put('key', nx.Graph())
+            cache.put('key', nx.Graph())
+            self.assertEqual(os.listdir(cache.directory), ['key.npz'])
+            if os.name == 'posix':
+                self.assertEqual(os.stat(cache.directory).st_mode & 0777, 0700)
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+""" Memory-mapped access to the fibers of TrackVis files
+
+Loading a TrackVis file with nibabel reads all fibers into a list of
+arrays, which takes minutes and many gigabytes for millions of fibers.
+A TrackFile instead scans the file once for the position of each fiber,
+then serves fibers or subsets of them as views of the memory-mapped file,
+such that only the requested fibers are read from disk.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+# Standard library imports
+import os
+import os.path as op
+import mmap
+import shutil
+import struct
+import tempfile
+from hashlib import sha1
+from zipfile import ZipFile
+
+import numpy as np
+from nibabel.trackvis import header_2_dtype
+
+from packed_fibers import PackedFibers
+
+# Logging import
+import logging
+logger = logging.getLogger('root.'+__name__)
+
+HEADER_SIZE = 1000
+
+# number of points copied at once by TrackFile.packed
+CHUNK_POINTS = 1000000
+
+# number and size of the blocks spread over the file hashed by TrackFile.fingerprint
+FINGERPRINT_BLOCKS = 64
+FINGERPRINT_BLOCK_SIZE = 65536
+
+class TrackFile(object):
+    """ A lazily indexed, memory-mapped TrackVis file
+
+    The index of the fibers is built on first access to a fiber.
+
+    Parameters
+    ----------
+    fname : string
+        the .trk file
+    tmpdir : string, optional
+        a temporary directory holding the file, removed by close()
+    stamp : string, optional
+        identifies the version of the file in the fingerprint, instead of
+        its modification time, e.g. for files extracted from an archive
+    """
+
+    def __init__(self, fname, tmpdir = None, stamp = None):
+        self.fname = fname
+        self._tmpdir = tmpdir
+        self._stamp = stamp
+        f = open(fname, 'rb')
+        try:
+            hdr = f.read(HEADER_SIZE)
+        finally:
+            f.close()
+        if len(hdr) < HEADER_SIZE:
+            raise IOError('%s is not a TrackVis file' % fname)
+
+        # the header size tells the endianness of the file
+        dtype = np.dtype(header_2_dtype)
+        header = np.frombuffer(hdr, dtype = dtype)[0]
+        if header['hdr_size'] != HEADER_SIZE:
+            dtype = dtype.newbyteorder()
+            header = np.frombuffer(hdr, dtype = dtype)[0]
+            if header['hdr_size'] != HEADER_SIZE:
+                raise IOError('Invalid header size in %s' % fname)
+        self.header = header
+        self.endianness = dtype['hdr_size'].byteorder
+        if self.endianness == '=':
+            self.endianness = '<'
+        self.n_scalars = int(header['n_scalars'])
+        self.n_properties = int(header['n_properties'])
+
+        self._float = np.dtype(self.endianness + 'f4')
+        self._offsets = None
+        self._lengths = None
+        self._data = None
+
+    @classmethod
+    def from_cfflib(cls, obj):
+        """ Opens the source file of a cfflib CTrack
+
+        Tracks in a zipped connectome file are extracted to a temporary
+        directory first, as zip members can not be memory-mapped. Their
+        CRC-32 and date in the archive stamp the fingerprint.
+        """
+        if obj.parent_cfile.iszip:
+            tmpdir = tempfile.mkdtemp(prefix = 'cviewer_track')
+            zf = ZipFile(obj.parent_cfile.src, 'r')
+            try:
+                info = zf.getinfo(obj.src)
+                fname = zf.extract(info, tmpdir)
+            finally:
+                zf.close()
+            stamp = '%08x-%04d%02d%02d%02d%02d%02d' % ((info.CRC,) + info.date_time)
+            return cls(fname, tmpdir, stamp)
+        elif hasattr(obj, 'tmpsrc'):
+            return cls(obj.tmpsrc)
+        else:
+            return cls(op.join(op.dirname(obj.parent_cfile.fname), obj.src))
+
+    def _index(self):
+        """ Scans the file once for the offset and length of each fiber """
+        if not self._offsets is None:
+            return
+        self._data = np.memmap(self.fname, dtype = np.uint8, mode = 'r')
+        n_count = int(self.header['n_count'])
+        point_size = 4 * (3 + self.n_scalars)
+        fiber_size = 4 + 4 * self.n_properties
+        unpack = struct.Struct(self.endianness + 'i').unpack_from
+
+        f = open(self.fname, 'rb')
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            size = len(mm)
+            # int64 buffers, a C long is 32 bits on Windows; n_count is
+            # zero if the number of fibers is unknown, then they grow
+            offsets = np.empty(n_count or 1024, dtype = np.int64)
+            lengths = np.empty(len(offsets), dtype = np.int64)
+            i = 0
+            pos = HEADER_SIZE
+            while pos < size and (n_count == 0 or i < n_count):
+                if i == len(offsets):
+                    offsets = np.resize(offsets, 2 * i)
+                    lengths = np.resize(lengths, 2 * i)
+                n, = unpack(mm, pos)
+                offsets[i] = pos
+                lengths[i] = n
+                pos += fiber_size + n * point_size
+                i += 1
+        finally:
+            mm.close()
+        if pos > size:
+            raise IOError('The TrackVis file %s is truncated' % self.fname)
+
+        self._offsets = offsets[:i].copy()
+        self._lengths = lengths[:i].copy()
+        logger.debug('Indexed %d fibers of %s' % (len(self._offsets), self.fname))
+
+    @property
+    def offsets(self):
+        """ Byte offset of each fiber in the file """
+        self._index()
+        return self._offsets
+
+    @property
+    def lengths(self):
+        """ Number of points of each fiber """
+        self._index()
+        return self._lengths
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _record(self, i):
+        """ The (n_points, 3 + n_scalars) array of fiber i """
+        self._index()
+        return np.ndarray( (self._lengths[i], 3 + self.n_scalars), dtype = self._float,
+                           buffer = self._data, offset = int(self._offsets[i]) + 4 )
+
+    def fiber(self, i):
+        """ The (n_points, 3) points of fiber i, a read-only view of the file """
+        return self._record(i)[:, :3]
+
+    def scalars(self, i):
+        """ The (n_points, n_scalars) scalars of fiber i """
+        return self._record(i)[:, 3:]
+
+    def properties(self, i):
+        """ The n_properties properties of fiber i """
+        self._index()
+        offset = int(self._offsets[i]) + 4 + 4 * (3 + self.n_scalars) * int(self._lengths[i])
+        return np.ndarray( (self.n_properties,), dtype = self._float,
+                           buffer = self._data, offset = offset )
+
+    def fibers(self, indices = None):
+        """ The points of several fibers as an object array of views
+
+        Parameters
+        ----------
+        indices : slice, integer array or boolean mask, optional
+            the fibers, all if None
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        else:
+            indices = np.arange(len(self))[indices]
+        fibers = np.empty(len(indices), dtype = object)
+        for j, i in enumerate(indices):
+            fibers[j] = self.fiber(i)
+        return fibers
+
+    def packed(self, indices = None):
+        """ The points of several fibers as PackedFibers
+
+        The points are gathered from the file in chunks of fibers with
+        vectorized indexing, without creating an array per fiber.
+
+        Parameters
+        ----------
+        indices : slice, integer array or boolean mask, optional
+            the fibers, all if None
+        """
+        self._index()
+        if indices is None:
+            indices = np.arange(len(self))
+        else:
+            indices = np.arange(len(self))[indices]
+        lengths = self._lengths[indices]
+        offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+        np.cumsum(lengths, out = offsets[1:])
+        points = np.empty( (offsets[-1], 3), dtype = np.float32 )
+
+        # the file as 4-byte words, the header size is a multiple of 4
+        words = self._data[:len(self._data) // 4 * 4].view(self._float)
+        row = 3 + self.n_scalars
+        # first word of each fiber's points
+        starts = (self._offsets[indices] + 4) // 4
+        # fiber boundaries of chunks of about CHUNK_POINTS points
+        bounds = np.unique( np.concatenate( (np.searchsorted(offsets,
+                    np.arange(0, offsets[-1], CHUNK_POINTS), 'right') - 1, [len(lengths)]) ) )
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            n = offsets[b] - offsets[a]
+            local = offsets[a:b] - offsets[a]
+            # first word of each point of the chunk
+            w = np.repeat(starts[a:b] - local * row, lengths[a:b]) + np.arange(n) * row
+            points[offsets[a]:offsets[b]] = words[w[:,None] + np.arange(3)]
+        return PackedFibers(points, offsets)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return self.fiber(key)
+        return self.fibers(key)
+
+    def fingerprint(self):
+        """ A string identifying the version and content of the file
+
+        The size, the modification time or the stamp given on creation,
+        and a hash of the header, of FINGERPRINT_BLOCKS blocks spread over
+        the file and of its end; small files are hashed entirely. It is
+        cheap to compute for large files, but a rewrite keeping the size
+        and the modification time, and changing only bytes outside of the
+        hashed blocks, is not detected.
+        """
+        size = op.getsize(self.fname)
+        if self._stamp is None:
+            stamp = repr(op.getmtime(self.fname))
+        else:
+            stamp = self._stamp
+        f = open(self.fname, 'rb')
+        try:
+            h = sha1(f.read(HEADER_SIZE))
+            if size - HEADER_SIZE <= (FINGERPRINT_BLOCKS + 1) * FINGERPRINT_BLOCK_SIZE:
+                h.update(f.read())
+            else:
+                step = (size - HEADER_SIZE) // FINGERPRINT_BLOCKS
+                for i in xrange(FINGERPRINT_BLOCKS):
+                    f.seek(HEADER_SIZE + i * step)
+                    h.update(f.read(FINGERPRINT_BLOCK_SIZE))
+                f.seek(size - FINGERPRINT_BLOCK_SIZE)
+                h.update(f.read())
+        finally:
+            f.close()
+        return '%d-%s-%s' % (size, stamp, h.hexdigest())
+
+    def close(self):
+        """ Releases the memory map and removes the temporary files """
+        self._data = None
+        if not self._tmpdir is None:
+            shutil.rmtree(self._tmpdir, ignore_errors = True)
+            self._tmpdir = None
@@ -2,26 +2,12 @@ writegexf = '''
 """ Convert a connectome network to the GEXF format
 readable by Gephi for further analysis and visualization """
 
-import networkx as nx
-import numpy as np
-
-cnet = cfile.obj.get_by_name('connectome_freesurferaparc')
-cnet.load()
+cnet = cfile.get_network_by_name('connectome_freesurferaparc')
 outpath = 'out.gexf'
 
-def fix_float_for_gexf(network):
-    for u,v,d in network.edges_iter(data=True):
-        for k,v in d.items():
-            if isinstance(d[k], np.float64):
-                d[k] = float( d[k] )
-    for u,d in network.nodes_iter(data=True):
-        for k,v in d.items():
-            if isinstance(d[k], np.float64):
-                d[k] = float( d[k] )
-    return network
-
-G = fix_float_for_gexf(cnet.data)
-nx.write_gexf(cnet.data, outpath)
+# the file is streamed from the node and edge attribute arrays,
+# use cnet.write_graphml(outpath) for GraphML
+cnet.write_gexf(outpath)
 '''
 
 corticocortico ='''
@@ -62,45 +48,30 @@ con = cfile.obj
 # alternatively when loading from Ipython directly with cfflib
 # con = cf.load('meta.cml')
 
-def load_data(con):
-
-    fibobj = con.get_by_name('Final Tractography (freesurferaparc)')
-    fibobj.load()
-    fibers = fibobj.get_fibers_as_numpy()
-    fibershdr = fibers.data[1]
+def load_data(cfile):
 
-    epmmobj = con.get_by_name('Fiber mean curvature')
+    track = cfile.get_track_by_name('Final Tractography (freesurferaparc)')
+    # the fibers are read from the memory-mapped track file when needed,
+    # only the selected ones with track.get_fibdata(indices)
+    fibershdr = track.track_file().header
 
-    eleobj = con.get_by_name('Final fiber lengths (freesurferaparc)')
-    eleobj.load()
-    lenghts = eleobj.data
-
-    emobj = con.get_by_name('Fiber mean curvature')
-    emobj.load()
-    meancurv = emobj.data
+    # the per-fiber metrics are computed at once on the packed fibers
+    # and cached with the track
+    metrics = track.metrics()
+    lenghts = metrics.length()
+    meancurv = metrics.mean_curvature()
 
     print "Compute endpoints [mm] array"
-    endpoints = np.zeros( (len(fibers), 2, 3), dtype = np.float32 )
-    for i in xrange(len(fibers)):
-        endpoints[i,0,:] = fibers[i][0,:]
-        endpoints[i,1,:] = fibers[i][-1,:]
+    endpoints = metrics.endpoints()
 
-    return fibers, fibershdr, lenghts, meancurv, endpoints
+    return track, fibershdr, lenghts, meancurv, endpoints, metrics
 
 # load stuff, can uncomment for rerunning the script in ipython with
 # run -i script.py
-fibers, fibershdr, lenghts, meancurv, endpoints = load_data(con)
+track, fibershdr, lenghts, meancurv, endpoints, metrics = load_data(cfile)
 
 # Helper functions
 
-def compute_start_end_distances(endpoints):
-    n = endpoints.shape[0]
-    di = np.zeros( (n, 1) )
-    for i in xrange(n):
-        d = np.abs(endpoints[i,0,:]-endpoints[i,1,:])
-        di[i,0] = np.sqrt(np.dot(d,d))
-    return di
-
 def sidx(arr, value):
     """ Returns the indices that are smaller or equal to the given array """
     return np.where( arr <= value)[0]
@@ -171,22 +142,10 @@ def preparecolorarray(clustering, number_of_fibers):
     colors[:,3] = 1.0 # need alpha channel
     return colors
 
-def angle(x,y): return np.rad2deg(np.arccos(np.dot(x,y)/np.sqrt(np.dot(x,x))/np.sqrt(np.dot(y,y))))
-
-def compute_angle_array(tracksobj, downsampling = 3):
-    n = tracksobj.shape[0]
-    fiberangles = np.zeros( (n, 1) )
-    if downsampling == 3:
-        for i in xrange(n):
-            x=tracksobj[i][0]-tracksobj[i][1]
-            y=tracksobj[i][2]-tracksobj[i][1]
-            fiberangles[i] = angle(x,y)
-    return fiberangles
-
 # start script
 
 # Compute the distance array
-dist = compute_start_end_distances(endpoints)
+dist = metrics.start_end_distance()
 
 # Inspect histogram to find xcenterline
 # hist(endpoints[:,0,0],200)
@@ -205,16 +164,15 @@ noccidx = np.intersect1d(noccidx , onlyleftidx)
 # 4. filter out corpous callosum fibers
 # noccidx = compfilterccidx(endpoints, 84, False)
 
-noccfibers = fibers[noccidx]
-
 # 5. show fibers without cc
+#noccfibers = track.get_fibdata(noccidx)
 #showfibfvtk(noccfibers,randcolarr(noccfibers), 1000)
 
 # 6. look at distance histogram
 #hist(dist,100)
 
 # 7. compute new distance histogram for fibers without cc
-distnocc = compute_start_end_distances(endpoints[noccidx,:,:])
+distnocc = dist[noccidx]
 meancuvnocc = meancurv[noccidx]
 #hist(distnocc,100)
 #hist(meancuvnocc,100)
@@ -224,7 +182,8 @@ meancuvnocc = meancurv[noccidx]
 #showfibfvtk(shortfibers,randcolarr(shortfibers), 100)
 
 # using meancurvature
-shortfibers = noccfibers[filterfibersidx2(distnocc, 10, 30, meancuvnocc, 0.05)]
+shortidx = noccidx[filterfibersidx2(distnocc, 10, 30, meancuvnocc, 0.05)]
+shortfibers = track.get_fibdata(shortidx)
 #showfibfvtk(shortfibers,randcolarr(shortfibers), 10)
 
 #shortfibers = noccfibers[filterfibersidx(dist, 8, 40)]
@@ -233,21 +192,20 @@ shortfibers = noccfibers[filterfibersidx2(distnocc, 10, 30, meancuvnocc, 0.05)]
 # 8-40: enough U fibers
 
 # 9. fiber clustering
-fiblist = shortfibers.tolist()
-print("Downsampling...")
-tracks=[tm.downsample(t,3) for t in fiblist]
-
-# calculate the angle of downsampled fibers
-tracksobj=np.array(tracks, dtype=np.object)
-
-fiberangles = compute_angle_array(tracksobj)
+# the angle at the midpoint of the fibers, as of fibers downsampled to 3 points
+fiberangles = metrics.angle()[shortidx]
 
 # filter fibers
 fiberangleidx = filterfibersidx(fiberangles, 20, 80)
 
+fiblist = shortfibers[fiberangleidx].tolist()
+print("Downsampling...")
+tracks=[tm.downsample(t,3) for t in fiblist]
+tracksobj=np.array(tracks, dtype=np.object)
+
 # create new short fiber set
 shortfibersnew = shortfibers[fiberangleidx]
-tracksobjnew = tracksobj[fiberangleidx]
+tracksobjnew = tracksobj
 
 print("Clustering....")
 now=time.clock()
@@ -305,32 +263,32 @@ import networkx as nx
 import numpy as np
 from mayavi import mlab
 
-# Retrieve NetworkX graph
-G = cfile.obj.get_by_name("connectome_freesurferaparc").data
+# Retrieve the network and its nodes and edges as arrays
+net = cfile.get_network_by_name("connectome_freesurferaparc")
+G = net.graph
+cols = net.columns()
 
 # Key value on the nodes to transform to scalar value for node coloring
 node_scalar_key = "dn_correspondence_id"
 
 # Network Layouting: 2d circular layout
 pos=nx.circular_layout(G,dim=2,scale=1)
-# numpy array of x,y,z positions in sorted node order
-xyz=np.array([pos[v] for v in sorted(G)])
+# numpy array of x,y,z positions in node order
+xyz=np.array([pos[v] for v in cols.nodes])
 # adding zero z coordinate
 xyz = np.hstack( (xyz, np.zeros( (len(xyz), 1) ) ) )
 
 # Network Layouting: 3d spring layout
 #pos=nx.spring_layout(G,dim=3)
-# numpy array of x,y,z positions in sorted node order
-#xyz=np.array([pos[v] for v in sorted(G)])
+# numpy array of x,y,z positions in node order
+#xyz=np.array([pos[v] for v in cols.nodes])
 
 # If you do not want to apply a layouting algorithm
 # You can create the xyz array from your node positions
 # as displayed in Code Oracle "3D Network"
 
 # scalar colors
-scalars = np.zeros( (len(G.nodes()),) )
-for i,data in enumerate(G.nodes(data=True)):
-    scalars[i] = float(data[1][node_scalar_key])
+scalars = cols.float_values('node', node_scalar_key)
 
 mlab.figure(1, bgcolor=(0, 0, 0))
 mlab.clf()
@@ -344,7 +302,7 @@ pts = mlab.points3d(xyz[:,0], xyz[:,1], xyz[:,2],
 
 # Defines only the connectivity
 # You can combine this script with the "3D Network" Code Oracle
-pts.mlab_source.dataset.lines = np.array(G.edges())
+pts.mlab_source.dataset.lines = np.vstack( (cols.src, cols.dst) ).T
 tube = mlab.pipeline.tube(pts, tube_radius=0.008)
 mlab.pipeline.surface(tube, color=(0.8, 0.8, 0.8))
 
@@ -496,8 +454,9 @@ from cviewer.visualization.matrix.con_matrix_viewer import ConnectionMatrixViewe
 # Retrieving the data
 # -------------------
 
-# retrieve the graph
-g = cfile.obj.get_by_name("%s").data
+# retrieve the network
+net = cfile.get_network_by_name("%s")
+g = net.graph
 
 # set the node key to use the labels
 nodelabelkey = "%s"
@@ -505,16 +464,9 @@ nodelabelkey = "%s"
 # Defining some helper functions
 # ------------------------------
 
-def relabel_to_int(graph):
-    " Relabel string node ids to integer "
-    def intmap(x): return int(x)
-    return nx.relabel_nodes(graph,intmap)
-
-def get_nodelabels(graph, nodekey = 'dn_label'):
-    " Retrieve a list of node labels "
-    g = relabel_to_int(graph)
-    a = []
-    return [v[nodekey] for n,v in g.nodes_iter(data=True)]
+def get_nodelabels(net, nodekey = 'dn_label'):
+    " Retrieve a list of node labels in matrix order "
+    return [net.graph.node[n][nodekey] for n in net.node_order()]
 
 def get_edge_values(graph):
     " Retrieve valid edge keys "
@@ -528,27 +480,23 @@ def get_edge_values(graph):
             ret.append(k)
     return ret
 
-def get_matdict(graph):
-    matdict = {}
-    g = relabel_to_int(graph)
-    # grab keys from the first edge, discarding id
-    dl = get_edge_values(g)
-    # create numpy matrix for each key using recarray
-    matrec = nx.to_numpy_recarray(g, dtype=zip(dl, [float]*len(dl)) )
-    for k in dl:
-        matdict[k] = matrec[k]
-    return matdict
-
-def invoke_matrix_viewer(graph, nodelabelkey = 'dn_label'):
+def get_matrix(edgekey):
+    " The sparse matrix of an edge key, computed when it is selected "
+    return net.matrix(edgekey, sparse = True)
+
+def invoke_matrix_viewer(net, nodelabelkey = 'dn_label'):
     " Invoke the Connectome Matrix Viewer "
-    cmatrix_viewer = ConnectionMatrixViewer(get_nodelabels(graph, nodekey = nodelabelkey),
-                                  get_matdict(graph))
+    # grab keys from the first edge, discarding id
+    dl = get_edge_values(net.graph)
+    # only the matrices of the last few selected keys are kept in memory
+    cmatrix_viewer = ConnectionMatrixViewer(get_nodelabels(net, nodekey = nodelabelkey),
+                                  get_matrix, keys = dl, cache_size = 4)
     cmatrix_viewer.edit_traits()
 
 # Perform task
 # ------------
 
-invoke_matrix_viewer(g, nodelabelkey)
+invoke_matrix_viewer(net, nodelabelkey)
 """
 
 conmatrixpyplot = """
@@ -562,8 +510,8 @@ import numpy as np
 # Retrieving the data
 # -------------------
 
-# retrieve the graph
-g = cfile.obj.get_by_name("%s").data
+# retrieve the network
+net = cfile.get_network_by_name("%s")
 
 # define the edge key to plot
 edgekey = "%s"
@@ -574,10 +522,9 @@ binarize = False
 # Defining some helper functions
 # ------------------------------
 
-def show_matrix(a, edge, binarize = False):
-    for u,v,d in a.edges_iter(data=True):
-        a.edge[u][v]['weight'] = a.edge[u][v][edge]
-    bb=nx.to_numpy_matrix(a)
+def show_matrix(net, edge, binarize = False):
+    # the matrix is cached by the network
+    bb = net.matrix(edge)
     if binarize:
         c=np.zeros(bb.shape)
         c[bb>0] = 1
@@ -589,7 +536,7 @@ def show_matrix(a, edge, binarize = False):
 
 # Perform task
 # ------------
-show_matrix(g, edgekey, binarize)
+show_matrix(net, edgekey, binarize)
 
 """
 
@@ -602,8 +549,11 @@ import dipy.viz.fvtk as fvtk
 # Retrieving the data and set parameters
 # --------------------------------------
 
-a = cfile.obj.get_by_name("Final Tractography (freesurferaparc)").get_fibers_as_numpy()
-fiberlabels = cfile.obj.get_by_name("Final fiber labels (freesurferaparc)").data
+track = cfile.get_track_by_name("Final Tractography (freesurferaparc)")
+fiberlabels = cfile.get_data_by_name("Final fiber labels (freesurferaparc)")
+
+# the fibers of each pair of labels, built once for the track
+index = track.label_index(fiberlabels)
 
 fromid = 8
 toid = 10
@@ -611,10 +561,6 @@ toid = 10
 # Defining some helper functions
 # ------------------------------
 
-def sidx(arr, fromval, toval):
-    " Returns the indices that are equal to a given value "
-    return np.where( (arr[:,0] == fromval) & (arr[:,1] == toval) )[0]
-
 def randcolarr(arr):
     " Returns a random color for each row in arr "
     return np.random.rand(1,3).repeat(len(arr),axis=0)
@@ -633,8 +579,10 @@ def showfibfvtk(fibarr, colarr, percentage = 100):
 # Perform task
 # ------------
 
-idx = sidx(fiberlabels, fromid, toid)
-showfibfvtk(a[idx], randcolarr(a[idx]), 100)
+idx = index.fibers(fromid, toid)
+# all fibers touching a region are given by index.region_fibers(fromid)
+fibers = track.get_fibdata(idx)
+showfibfvtk(fibers, randcolarr(fibers), 100)
 
 """
 
@@ -648,8 +596,9 @@ from tvtk.api import tvtk
 # Retrieving the data and set parameters
 # --------------------------------------
 
-# load graph data
-g = cfile.obj.get_by_name("%s").data
+# load the network with its nodes and edges as arrays
+net = cfile.get_network_by_name("%s")
+cols = net.columns()
 position_key = "%s"
 edge_key = "%s"
 node_label_key = "%s"
@@ -657,34 +606,18 @@ node_label_key = "%s"
 # Node ids you want to create labels for
 create_label = []
 
-# Assume node id's are integers
-nr_nodes = len(g.nodes())
-position_array = np.zeros( (nr_nodes, 3) )
-for i,nodeid in enumerate(g.nodes()):
-    pos = g.node[nodeid][position_key]
-    # apply a conversion procedure if the position
-    # is a tuple store as string
-    # we need a numpy array in the end
-    if type(pos) is str or unicode:
-        pos = tuple(float(s) for s in pos[1:-1].split(','))
-    pos = np.array(pos)
-    position_array[i,:] = pos
+# The node positions as a (nr_nodes, 3) array,
+# positions stored as tuple strings are converted
+position_array = cols.node[position_key]
 
 x, y, z = position_array[:,0], position_array[:,1], position_array[:,2]
 
-# Retrieve the edges and create a Numpy array
-edges = np.array(g.edges())
+# The edges as rows of the position array
+edges = np.vstack( (cols.src, cols.dst) ).T
 nr_edges = len(edges)
 
 # Retrieve edge values
-ev = np.zeros( (nr_edges, 1) )
-for i,d in enumerate(g.edges_iter(data=True)):
-    ev[i] = d[2][edge_key]
-    # ensure that we are setting the correct edge
-    assert d[0] == edges[i,0] and d[1] == edges[i,1]
-
-# Need to subtract one because the array index starts at zero
-edges = edges - 1
+ev = cols.float_values('edge', edge_key).reshape( (nr_edges, 1) )
 
 # Create vectors which will become edges
 start_positions = position_array[edges[:, 0], :].T
@@ -739,9 +672,8 @@ myvectors.glyph.color_mode = 'color_by_scalar'
 myvectors.glyph.glyph.clamping = False
 
 # create labels
-for la in create_label:
-    row_index = la - 1
-    label = g.node[la][node_label_key]
+for la, row_index in zip(create_label, cols.node_index(create_label)):
+    label = cols.node[node_label_key][row_index]
     mlab.text3d(position_array[row_index,0],
                 position_array[row_index,1],
                 position_array[row_index,2],
@@ -792,42 +724,16 @@ SHOW_MATRIX = True
 # Perform task
 # ------------
 
-# Get the connectome objects for the given connectome network names
-firstgroup = [cfile.obj.get_by_name(n) for n in first]
-secondgroup = [cfile.obj.get_by_name(n) for n in second]
-
-# Make sure that all networks are loaded in memory
-for net in firstgroup:
-    net.load()
-for net in secondgroup:
-    net.load()
-
-# Convert your network data for each group into numpy arrays
-nr1_networks = len(firstgroup)
-nr1_nrnodes = len(firstgroup[0].data.nodes())
-
-nr2_networks = len(secondgroup)
-nr2_nrnodes = len(secondgroup[0].data.nodes())
-
-X = np.zeros( (nr1_nrnodes, nr1_nrnodes, nr1_networks) )
-Y = np.zeros( (nr2_nrnodes, nr2_nrnodes, nr2_networks) )
-
-# Fill in the data from the networks
-for i, sub in enumerate(firstgroup):
-    graph=sub.data
-    # Setting the edge requested edge value as weight value
-    for u,v,d in graph.edges(data=True):
-        graph[u][v]['weight']=d[first_edge_value]
-    # Retrieve the matrix
-    X[:,:,i] = nx.to_numpy_matrix(graph)
-
-for i, sub in enumerate(secondgroup):
-    graph=sub.data
-    # Setting the edge requested edge value as weight value
-    for u,v,d in graph.edges(data=True):
-        graph[u][v]['weight']=d[second_edge_value]
-    # Retrieve the matrix
-    Y[:,:,i] = nx.to_numpy_matrix(graph)
+# Load the networks of each group and stack their
+# matrices into N x N x subjects arrays
+X = cfile.stack_networks(first, first_edge_value)
+Y = cfile.stack_networks(second, second_edge_value)
+firstgroup = [cfile.get_network_by_name(n) for n in first]
+secondgroup = [cfile.get_network_by_name(n) for n in second]
+
+# The rows of X and Y must refer to the same nodes
+if firstgroup[0].node_order() != secondgroup[0].node_order():
+    raise ValueError('The networks of the two groups do not have the same nodes')
 
 # Perform task
 # ------------
@@ -835,7 +741,10 @@ for i, sub in enumerate(secondgroup):
 # Compute NBS, this might take a long time
 # and might better be done in a seperate script
 
-PVAL, ADJ, NULL = nbs.compute_nbs(X,Y,THRESH,K,TAIL)
+# Report the progress every 100 permutations and the time spent
+timing = {}
+PVAL, ADJ, NULL = nbs.compute_nbs(X,Y,THRESH,K,TAIL,progress=nbs.print_progress(100),timing=timing)
+nbs.print_timing(timing)
 
 # We can now look at the connectivity matrix identified with matplotlib
 if SHOW_MATRIX:
@@ -849,7 +758,7 @@ nbsgraph = nx.from_numpy_matrix(ADJ)
 nbsgraph=nx.relabel_nodes(nbsgraph, lambda x: x + 1)
 # populate node dictionaries with attributes from first network of the first group
 # it must include some location information to display it
-for nid, ndata in firstgroup[0].data.nodes_iter(data=True):
+for nid, ndata in firstgroup[0].graph.nodes_iter(data=True):
     nbsgraph.node[nid] = ndata
 
 # Find a date
@@ -945,15 +854,17 @@ tmpdir = tempfile.gettempdir()
 # -------------------
 
 # the network for the reporting
-net = cfile.obj.get_by_name('connectome_freesurferaparc')
-net.load()
+cnet = cfile.get_network_by_name('connectome_freesurferaparc')
+net = cnet.obj
 # the edge key
 de_key = 'number_of_fibers'
 # output file name
 fname = os.path.join(tmpdir, 'out.pdf')
 
 date = today.strftime('Reported on %dth, %h %Y')
-netw = net.data
+# the binary and weighted metrics, computed from the cached matrices
+metrics = cnet.metrics()
+wmetrics = cnet.metrics(de_key)
 
 def header(txt, style=HeaderStyle, klass=Paragraph, sep=0.3):
     s = Spacer(0.2*inch, sep*inch)
@@ -981,14 +892,7 @@ mydate = header(date, sep=0.1, style=ParaStyle)
 
 mytitlenet = header(net.get_name() + " (CNetwork)")
 
-for u,v,d in netw.edges_iter(data=True):
-    edgval = netw.edge[u][v][de_key]
-    if edgval > 0:
-        netw.edge[u][v]['weight'] = 1
-    else:
-        netw.edge[u][v]['weight'] = 1
-
-b=nx.to_numpy_matrix(netw)
+b=cnet.matrix()
 fig = plt.figure()
 fig.suptitle("Binary Connection matrix")
 aa= plt.imshow(b, interpolation='nearest', cmap=plt.cm.Greys, vmin = b.min(), vmax=b.max())
@@ -996,28 +900,30 @@ fig.savefig(os.path.join(tmpdir, 'matrix.png'))
 
 fig.clear()
 fig.suptitle("Degree distribution")
-plt.hist(netw.degree().values(),30)
+plt.hist(metrics.degree(),30)
 fig.savefig(os.path.join(tmpdir,'distri.png'))
 
 # measures
-if nx.is_connected(netw):
+if metrics.number_of_components() == 1:
     isit = "Yes"
 else:
     isit = "No"
-me1 = p("Number of Nodes: " + str(netw.number_of_nodes()))
-me2 = p("Number of Edges: " +  str(netw.number_of_edges()))
+me1 = p("Number of Nodes: " + str(metrics.number_of_nodes()))
+me2 = p("Number of Edges: " +  str(metrics.number_of_edges()))
 me3 = p("Is network connected: " + isit)
-me4 = p("Number of connected components: " + str(nx.number_connected_components(netw)))
-me44 = p("Average node degree: %.2f" % np.mean(netw.degree().values()))
-me5 = p("Average unweighted shortest path length: %.2f" % nx.average_shortest_path_length(netw, weighted = False))
-me6 = p("Average clustering coefficient: %.2f" % nx.average_clustering(netw))
+me4 = p("Number of connected components: " + str(metrics.number_of_components()))
+me44 = p("Average node degree: %.2f" % np.mean(metrics.degree()))
+me45 = p("Average node strength (%s): %.2f" % (de_key, np.mean(wmetrics.strength())))
+me5 = p("Average unweighted shortest path length: %.2f" % metrics.characteristic_path_length())
+me55 = p("Global efficiency: %.2f" % metrics.global_efficiency())
+me6 = p("Average clustering coefficient: %.2f" % metrics.average_clustering())
 
 logo = os.path.join(tmpdir, "matrix.png")
 im1 = Image(logo, 300,225)
 logo = os.path.join(tmpdir, "distri.png")
 im2 = Image(logo, 250,188)
 
-codesection = [mytitle, mydate, mytitlenet, me1, me2, me3, me4,me44, me5, me6, im1, im2]
+codesection = [mytitle, mydate, mytitlenet, me1, me2, me3, me4,me44, me45, me5, me55, me6, im1, im2]
 src = KeepTogether(codesection)
 Elements.append(src)
 go(fname)
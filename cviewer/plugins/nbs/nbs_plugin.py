@@ -34,5 +34,6 @@ class NBSPlugin(Plugin):
         """ Exposes the nbs namespace in the python shell """
 
         return [
-            'import cviewer.libs.pyconto.groupstatistics.nbs as nbs' ]
+            'import cviewer.libs.pyconto.groupstatistics.nbs as nbs',
+            'from cviewer.libs.pyconto.groupstatistics.nbs import print_progress, print_timing' ]
         
@@ -6,7 +6,7 @@
 
 # Enthought library imports
 from apptools.preferences.ui.api import PreferencesPage
-from traits.api import Bool, Directory
+from traits.api import Bool, Directory, Int
 from traitsui.api import View, Group, Item
 
 class CViewerUIPreferencesPage(PreferencesPage):
@@ -38,12 +38,28 @@ class CViewerUIPreferencesPage(PreferencesPage):
     # show the ConnectomeViewer splash screen
     show_splash_screen = Bool(desc='if the Connectome Viewer splashscreen is shown on startup')
     
+    # cache loaded networks on disk
+    networkcache = Bool(desc='if loaded GraphML and GPickle networks are cached on disk')
+    
+    # directory of the network cache
+    networkcachepath = Directory(desc='the directory of the network cache, ~/.cviewer/network_cache if empty')
+    
+    # size limit of the network cache
+    networkcachesize = Int(desc='the size limit of the network cache in MB')
+    
+    # directory of the saved spatial indexes of tracks
+    spatialindexpath = Directory(desc='the directory of the saved spatial indexes of tracks, ~/.cviewer/spatial_index if empty')
+    
     #### Traits UI views ######################################################
     trait_view = View(Group(
                             Item('show_splash_screen', label='Show Splash Screen:'),
                             Item('useipython', label='Use IPython:'),
                             Item('cffpath', label='Connectome File Path:'),
                             Item('scriptpath', label='Python Script Path:'),
+                            Item('networkcache', label='Cache Networks:'),
+                            Item('networkcachepath', label='Network Cache Path:'),
+                            Item('networkcachesize', label='Network Cache Size (MB):'),
+                            Item('spatialindexpath', label='Spatial Index Path:'),
                            ),
                       resizable=True
                      )
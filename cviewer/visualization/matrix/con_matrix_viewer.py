@@ -6,6 +6,12 @@
    and alt-right-arrow moves you forwards and backwards through the "zoom 
    history".
 * Right-click on the colorbar selects highlighted value range
+
+Large matrices are displayed through a pyramid of block-aggregated levels,
+see MatrixPyramid. Only the visible window of the level matching the zoom
+is drawn, the block aggregation (maximum or mean) can be selected.
+The matrices may be scipy.sparse matrices, which are never converted
+to dense arrays as a whole.
 """
 # Copyright (C) 2009-2010, Ecole Polytechnique Federale de Lausanne (EPFL) and
 # University Hospital Center and University of Lausanne (UNIL-CHUV)
@@ -25,6 +31,11 @@ from traitsui.api import Item, Group, View, HGroup, Handler
 from chaco.api import ArrayPlotData, ColorBar, HPlotContainer, jet, LinearMapper, Plot
 from chaco.tools.api import PanTool, RangeSelection, RangeSelectionOverlay, ZoomTool
 
+# ConnectomeViewer imports
+from cviewer.visualization.matrix.pyramid import MatrixPyramid, visible_window, \
+    as_matrix, matrix_value
+from cviewer.visualization.matrix.matrix_provider import MatrixProvider
+
 class CustomHandler(Handler):
     """ Handler used to set NetworkName in TraitsTitle """
     
@@ -56,6 +67,15 @@ class ConnectionMatrixViewer(HasTraits):
     data = None
     val = Float
     nodelabels = Any
+    
+    # aggregation of the matrix cells when zoomed out
+    aggregation = Enum('max', 'mean')
+    
+    # the MatrixPyramid of the recently shown (edge key, aggregation) pairs
+    _pyramids = Any
+    
+    # the displayed level and window
+    _shown = Any
 
     traits_view = View(
                     Group(
@@ -67,27 +87,47 @@ class ConnectionMatrixViewer(HasTraits):
                         Item('val', label="Value", style = 'readonly', springy=True),
                         ),
                         orientation = "vertical"),
+                    HGroup(
                     Item('data_name', label="Edge key"),
+                    Item('aggregation', label="Zoomed out"),
+                    ),
                    # handler=CustomHandler(),
                     resizable=True, title="Connection Matrix Viewer"
                     )
 
     
-    def __init__(self, nodelabels, matdict, **traits):
+    def __init__(self, nodelabels, matdict, keys = None, cache_size = 4, **traits):
         """ Starts a matrix inspector
         
         Parameters
         ----------
         nodelables : list
             List of strings of labels for the rows of the matrix
-        matdict : dictionary
-            Keys are the edge type and values are NxN Numpy arrays """
+        matdict : dictionary or callable
+            Keys are the edge type and values are NxN Numpy arrays or
+            scipy.sparse matrices, or a function returning the matrix
+            of an edge type.
+            The function is called when the edge type is first selected.
+        keys : list, optional
+            The edge types, required if matdict is a function
+        cache_size : integer, optional
+            Number of matrices of a function kept in memory, the least
+            recently selected ones are discarded """
         super(HasTraits, self).__init__(**traits)
         
-        self.add_trait('data_name', Enum(matdict.keys()))
+        if isinstance(matdict, dict):
+            matdict = dict( (k, as_matrix(v)) for k, v in matdict.items() )
+        else:
+            fun = matdict
+            matdict = lambda key : as_matrix(fun(key))
+        self.data = MatrixProvider(matdict, keys, cache_size)
+        self._pyramids = MatrixProvider(lambda key : MatrixPyramid(self.data[key[0]], key[1]),
+                                        [ (k, a) for k in self.data.keys() for a in ('max', 'mean') ],
+                                        cache_size)
+        
+        self.add_trait('data_name', Enum(self.data.keys()))
         
-        self.data_name = matdict.keys()[0]
-        self.data = matdict
+        self.data_name = self.data.keys()[0]
         self.nodelables = nodelabels
         self.plot = self._create_plot_component()
         
@@ -96,9 +136,43 @@ class ConnectionMatrixViewer(HasTraits):
         self.custtool.on_trait_change(self._update_fields, "yval")
 
     def _data_name_changed(self, old, new):
-        self.pd.set_data("imagedata", self.data[self.data_name])
+        if self.tplot is None:
+            return
+        self._update_colormap()
+        self._update_image()
         #self.my_plot.set_value_selection((0, 2))
         self.tplot.title = "Connection Matrix for %s" % self.data_name
+
+    def _aggregation_changed(self):
+        if self.tplot is None:
+            return
+        self._update_image()
+
+    def _get_pyramid(self):
+        """ The pyramid of the current edge key, built on first use """
+        return self._pyramids[(self.data_name, self.aggregation)]
+
+    def _update_colormap(self):
+        """ Keeps the colors of the full matrix for any displayed window """
+        pyr = self._get_pyramid()
+        self.my_plot.color_mapper.range.set_bounds(pyr.min, pyr.max)
+
+    def _update_image(self):
+        """ Displays the visible window at the level matching the zoom """
+        pyr = self._get_pyramid()
+        xr = self.tplot.index_range
+        yr = self.tplot.value_range
+        # cells are centered on their 1-based index
+        level, data, xs, ys = visible_window(pyr, (xr.low, xr.high), (yr.low, yr.high),
+                                             self.tplot.width, self.tplot.height, 0.5)
+        
+        shown = (self.data_name, self.aggregation, level, xs[0], xs[-1], ys[0], ys[-1])
+        if shown == self._shown:
+            return
+        self._shown = shown
+        
+        self.pd.set_data("imagedata", data)
+        self.my_plot.index.set_data(xs, ys)
         
     def _update_fields(self):
         
@@ -114,17 +188,20 @@ class ConnectionMatrixViewer(HasTraits):
             col = " (index: %i" % (totmp + 1) + ")"
             self.fro = " " + str(self.nodelables[frotmp]) + row 
             self.to = " " + str(self.nodelables[totmp]) + col
-            self.val = self.data[self.data_name][frotmp, totmp]
+            self.val = matrix_value(self.data[self.data_name], frotmp, totmp)
         
     def _create_plot_component(self):
         
-        # Create a plot data object and give it this data
+        # Create a plot data object and give it the coarsest level,
+        # the displayed level is updated with the plot size
+        pyr = self._get_pyramid()
         self.pd = ArrayPlotData()
-        self.pd.set_data("imagedata", self.data[self.data_name])
+        self.pd.set_data("imagedata", pyr.window(len(pyr) - 1, (0, pyr.shape[0]),
+                                                 (0, pyr.shape[1]))[0])
     
         # find dimensions
-        xdim = self.data[self.data_name].shape[1]
-        ydim = self.data[self.data_name].shape[0]
+        xdim = pyr.shape[1]
+        ydim = pyr.shape[0]
     
         # Create the plot
         self.tplot = Plot(self.pd, default_origin="top left")
@@ -142,6 +219,14 @@ class ConnectionMatrixViewer(HasTraits):
         # Right now, some of the tools are a little invasive, and we need the 
         # actual CMapImage object to give to them
         self.my_plot = self.tplot.plots["my_plot"][0]
+        
+        # the ranges are those of the full matrix, not of the displayed window
+        self.tplot.index_range.set_bounds(0.5, xdim + 0.5)
+        self.tplot.value_range.set_bounds(0.5, ydim + 0.5)
+        self._update_colormap()
+        self.tplot.index_range.on_trait_change(self._update_image, "updated")
+        self.tplot.value_range.on_trait_change(self._update_image, "updated")
+        self.tplot.on_trait_change(self._update_image, "bounds")
     
         # Attach some tools to the plot
         self.tplot.tools.append(PanTool(self.tplot))
@@ -0,0 +1,63 @@
+""" Lazy access to the matrices of several edge keys for the matrix viewers """
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+from collections import OrderedDict
+
+class MatrixProvider(object):
+    """ The matrices of edge keys, computed on first access
+
+    Only the most recently accessed matrices are kept, such that the
+    matrices of networks with many edge keys are never all in memory.
+
+    Parameters
+    ----------
+    provider : callable or dictionary
+        function returning the matrix of an edge key, or a dictionary
+        of the matrices, which are then all kept
+    keys : list, optional
+        the edge keys, required if provider is a function
+    cache_size : integer, optional
+        number of matrices kept
+    """
+
+    def __init__(self, provider, keys = None, cache_size = 4):
+        if isinstance(provider, dict):
+            self._fun = provider.__getitem__
+            self._keys = list(provider.keys())
+            cache_size = len(self._keys)
+        else:
+            if keys is None:
+                raise ValueError('The keys are required with a provider function')
+            self._fun = provider
+            self._keys = list(keys)
+        self.cache_size = max(cache_size, 1)
+        self._cache = OrderedDict()
+
+    def keys(self):
+        return list(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        if key in self._cache:
+            # most recently used last
+            value = self._cache.pop(key)
+        else:
+            if not key in self._keys:
+                raise KeyError(key)
+            value = self._fun(key)
+            while len(self._cache) >= self.cache_size:
+                self._cache.popitem(last = False)
+        self._cache[key] = value
+        return value
+
+    def cached_keys(self):
+        """ The keys of the matrices in memory, least recently used first """
+        return list(self._cache.keys())
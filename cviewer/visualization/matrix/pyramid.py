@@ -0,0 +1,201 @@
+""" Multi-resolution pyramid of a matrix for the matrix viewers
+
+Level k of the pyramid aggregates blocks of 2^k x 2^k cells of the matrix
+by their maximum or mean. A viewer displays the coarsest level which still
+has at least one cell per screen pixel, and only the visible window of it,
+such that the displayed image never exceeds the size of the screen.
+
+Sparse matrices stay sparse: their levels are sparse as long as they are
+larger than dense_size x dense_size, and only the displayed window of a
+level is converted to a dense array.
+"""
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# University Hospital Center and University of Lausanne (UNIL-CHUV)
+#
+# Modified BSD License
+
+import numpy as np
+import scipy.sparse as sp
+
+class MatrixPyramid(object):
+    """ Block-aggregated levels of a matrix
+
+    Parameters
+    ----------
+    matrix : ndarray or scipy.sparse matrix
+        the full resolution matrix, level 0
+    method : {'max', 'mean'}
+        aggregation of the blocks
+    min_size : integer
+        no level is built after the first one smaller than min_size
+        in both dimensions
+    dense_size : integer
+        levels of sparse matrices are dense below dense_size x dense_size
+    """
+
+    def __init__(self, matrix, method = 'max', min_size = 256, dense_size = 2048):
+        if not method in ('max', 'mean'):
+            raise ValueError("method must be 'max' or 'mean'")
+        self.method = method
+        self.shape = matrix.shape
+        if sp.issparse(matrix):
+            self._build_sparse(matrix, min_size, dense_size)
+            return
+        self.levels = [ matrix ]
+        self.min = np.min(matrix)
+        self.max = np.max(matrix)
+
+        # number of cells of the matrix in the rows and columns of each level
+        rows = np.ones(self.shape[0])
+        cols = np.ones(self.shape[1])
+        M = np.asarray(matrix, dtype = np.float64)
+        while max(M.shape) > min_size:
+            if method == 'max':
+                M = _reduce_pairs(M, -np.inf, np.maximum)
+            else:
+                # weight the means by the cell counts to keep them exact
+                S = _reduce_pairs(M * rows[:,None] * cols[None,:], 0, np.add)
+                rows = _reduce_pairs(rows[:,None], 0, np.add)[:,0]
+                cols = _reduce_pairs(cols[None,:], 0, np.add)[0]
+                M = S / rows[:,None] / cols[None,:]
+            self.levels.append(M)
+
+    def _build_sparse(self, matrix, min_size, dense_size):
+        """ Builds the levels of a sparse matrix from its nonzero cells """
+        n0, n1 = self.shape
+        M = matrix.tocsr()
+        coo = M.tocoo()
+        self.levels = [ M ]
+        # the implicit zeros count for the minimum and maximum
+        values = coo.data
+        if coo.nnz < n0 * n1:
+            values = np.append(values, 0)
+        self.min = np.min(values)
+        self.max = np.max(values)
+
+        f = 1
+        shape = self.shape
+        while max(shape) > min_size:
+            f *= 2
+            shape = ( (n0 + f - 1) // f, (n1 + f - 1) // f )
+            key = (coo.row // f).astype(np.int64) * shape[1] + coo.col // f
+            order = np.argsort(key, kind = 'mergesort')
+            key = key[order]
+            start = np.concatenate( ([0], np.flatnonzero(np.diff(key)) + 1) )
+            key = key[start]
+            row, col = key // shape[1], key % shape[1]
+            # number of matrix cells in each block
+            cells = np.minimum(f, n0 - row * f) * np.minimum(f, n1 - col * f)
+            if self.method == 'max':
+                val = np.maximum.reduceat(coo.data[order], start)
+                # blocks with implicit zeros
+                count = np.diff( np.append(start, coo.nnz) )
+                val[count < cells] = np.maximum(val[count < cells], 0)
+            else:
+                val = np.add.reduceat(coo.data[order], start) / cells.astype(np.float64)
+            L = sp.csr_matrix( (val, (row, col)), shape = shape )
+            if shape[0] * shape[1] <= dense_size ** 2:
+                L = L.toarray()
+            self.levels.append(L)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def factor(self, level):
+        """ Number of matrix cells per cell of a level, in each dimension """
+        return 2 ** level
+
+    def level_for(self, cells_per_pixel):
+        """ The coarsest level with at least one cell per screen pixel """
+        if cells_per_pixel < 2:
+            return 0
+        level = int(np.floor(np.log2(cells_per_pixel)))
+        return min(level, len(self.levels) - 1)
+
+    def window(self, level, rows, cols):
+        """ The cells of a level covering a range of the matrix
+
+        Parameters
+        ----------
+        level : integer
+        rows, cols : (low, high)
+            row and column range in matrix cells, may exceed the matrix
+
+        Returns
+        -------
+        data : ndarray
+            the cells of the level, a view of dense levels
+        rows, cols : (low, high)
+            the range of matrix cells covered by data, high excluded
+        """
+        f = self.factor(level)
+        L = self.levels[level]
+        r0, r1 = _block_range(rows, f, L.shape[0])
+        c0, c1 = _block_range(cols, f, L.shape[1])
+        data = L[r0:r1, c0:c1]
+        if sp.issparse(data):
+            data = data.toarray()
+        return data, \
+            (r0 * f, min(r1 * f, self.shape[0])), \
+            (c0 * f, min(c1 * f, self.shape[1]))
+
+def visible_window(pyramid, xrange, yrange, width, height, offset = 0.5):
+    """ The part of a pyramid to display in a plot
+
+    Parameters
+    ----------
+    pyramid : MatrixPyramid
+    xrange, yrange : (low, high)
+        the visible range of the plot in data coordinates
+    width, height : integer
+        the size of the plot in pixels
+    offset : float
+        data coordinate of the lower edge of the first matrix cell
+
+    Returns
+    -------
+    level : integer
+        the displayed level
+    data : ndarray
+        the cells to display
+    xs, ys : ndarray
+        data coordinates of the edges of the columns and rows of data
+    """
+    cols = (xrange[0] - offset, xrange[1] - offset)
+    rows = (yrange[0] - offset, yrange[1] - offset)
+    level = pyramid.level_for( min( (cols[1] - cols[0]) / max(width, 1),
+                                    (rows[1] - rows[0]) / max(height, 1) ) )
+    data, rows, cols = pyramid.window(level, rows, cols)
+    f = pyramid.factor(level)
+    xs = np.minimum( cols[0] + f * np.arange(data.shape[1] + 1), cols[1] ) + offset
+    ys = np.minimum( rows[0] + f * np.arange(data.shape[0] + 1), rows[1] ) + offset
+    return level, data, xs, ys
+
+def as_matrix(matrix):
+    """ Dense arrays as they are, sparse matrices in CSR format for indexing """
+    if sp.issparse(matrix):
+        return matrix.tocsr()
+    return np.asarray(matrix)
+
+def matrix_value(matrix, i, j):
+    """ The value of a cell of a dense array or a CSR matrix """
+    return float(matrix[i, j])
+
+def _block_range(rng, f, n):
+    """ Blocks of size f covering the cell range rng, clipped to [0, n) """
+    low = int(np.floor(max(rng[0], 0) / float(f)))
+    high = int(np.ceil(max(rng[1], 0) / float(f)))
+    low = min(low, n - 1)
+    high = min(max(high, low + 1), n)
+    return low, high
+
+def _reduce_pairs(M, fill, ufunc):
+    """ Reduces the 2 x 2 blocks of M with ufunc, padding odd sizes with fill """
+    n0, n1 = M.shape
+    if n0 % 2 or n1 % 2:
+        P = np.empty( (n0 + n0 % 2, n1 + n1 % 2) )
+        P.fill(fill)
+        P[:n0, :n1] = M
+        M = P
+    B = M.reshape(M.shape[0] // 2, 2, M.shape[1] // 2, 2)
+    return ufunc.reduce(ufunc.reduce(B, axis = 3), axis = 1)
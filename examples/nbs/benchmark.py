@@ -0,0 +1,246 @@
+""" This script benchmarks the NBS on the example data and synthetic cohorts
+
+Each case runs in its own process, such that its peak memory is measured
+independently of the others. For each case, the total runtime, the peak
+memory, the number of permutations per second and the time spent in each
+stage of the permutations are reported. The peak memory includes loading
+or generating the data. It is the memory of the case process; with
+--n-jobs above 1, the peak of the largest permutation worker is reported
+separately, as the workers run at the same time as the case process.
+A case that fails is reported with its error instead. Synthetic cohorts above --dense-max nodes are
+written to a temporary memmap and run with compute_nbs_sparse.
+
+Run it from this folder, e.g.::
+
+    python benchmark.py
+    python benchmark.py --nodes 84,500 --perms 100 --output bench.csv
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+import traceback
+import multiprocessing
+from Queue import Empty
+from optparse import OptionParser
+
+import numpy as np
+import cviewer.libs.pyconto.groupstatistics.nbs as nbs
+
+# stages of the timing report of compute_nbs
+STAGES = ('read', 'ttest', 'threshold', 'components')
+
+# threshold of the example data, as in example1.py
+EXAMPLE_THRESH = 3
+
+# columns of the results table
+COLUMNS = ('case', 'engine', 'N', 'subjects', 'K', 'runtime', 'peak_mb',
+           'workers_peak_mb', 'perms_per_second') + STAGES + ('found', 'error')
+
+def load_example():
+    """ The example populations X.mat and Y.mat of this folder """
+    import scipy.io as io
+    path = os.path.dirname(os.path.abspath(__file__))
+    X = io.loadmat(os.path.join(path, 'X.mat'))['X']
+    Y = io.loadmat(os.path.join(path, 'Y.mat'))['Y']
+    return X, Y
+
+def planted_edges(N, size, rng):
+    """ Edges of a connected component of `size` random nodes (a ring with chords) """
+    nodes = np.sort( rng.permutation(N)[:size] )
+    i = nodes
+    j = np.roll(nodes, -1)
+    ci = nodes[::2]
+    cj = np.roll(nodes, -size // 3)[::2]
+    ij = np.vstack( (np.hstack((i, ci)), np.hstack((j, cj))) ).T
+    ij = ij[ ij[:,0] != ij[:,1] ]
+    ij = np.sort(ij, axis = 1)
+    # remove duplicates
+    key = np.unique( ij[:,0] * N + ij[:,1] )
+    return np.vstack( (key // N, key % N) ).T
+
+def synthetic_dense(N, nx, ny, effect, size, seed):
+    """ Two N x N x n cohorts, Y with an increased mean on a planted component """
+    rng = np.random.RandomState(seed)
+    X = rng.standard_normal( (N, N, nx) )
+    Y = rng.standard_normal( (N, N, ny) )
+    ij = planted_edges(N, size, rng)
+    Y[ij[:,0], ij[:,1], :] += effect
+    return X, Y, ij
+
+def synthetic_memmap(fname, N, nx, ny, effect, size, seed, chunk_size = 1000000):
+    """ Vectorized (M, nx+ny) float32 cohorts on disk, see compute_nbs_sparse """
+    rng = np.random.RandomState(seed)
+    M = N * (N - 1) // 2
+    D = np.memmap(fname, dtype = np.float32, mode = 'w+', shape = (M, nx + ny))
+    for start in range(0, M, chunk_size):
+        stop = min(start + chunk_size, M)
+        D[start:stop] = rng.standard_normal( (stop - start, nx + ny) )
+    ij = planted_edges(N, size, rng)
+    # linear index of the edges in np.triu_indices(N, 1) order
+    ind = ij[:,0] * (2 * N - ij[:,0] - 1) // 2 + ij[:,1] - ij[:,0] - 1
+    D[ind, nx:] += effect
+    D.flush()
+    del D
+    return np.memmap(fname, dtype = np.float32, mode = 'r', shape = (M, nx + ny)), ij
+
+def run_case(case, options):
+    """ Run the NBS for one case and return a row of the results table """
+    name, N = case
+    K = options.perms
+    timing = {}
+    tmpdir = None
+    try:
+        t0 = time.time()
+        if name == 'example':
+            X, Y = load_example()
+            N = X.shape[0]
+            engine = 'dense'
+            PVAL, ADJ, NULL = nbs.compute_nbs(X, Y, EXAMPLE_THRESH, K, 'left',
+                                              n_jobs = options.n_jobs, random_state = 0,
+                                              timing = timing)
+            found = np.sum(PVAL < 0.05)
+            nx, ny = X.shape[2], Y.shape[2]
+        else:
+            nx = ny = options.subjects
+            engine = options.engine
+            if engine == 'auto':
+                engine = 'dense' if N <= options.dense_max else 'sparse'
+            if engine == 'dense':
+                X, Y, ij = synthetic_dense(N, nx, ny, options.effect, options.size, N)
+                t0 = time.time()
+                PVAL, ADJ, NULL = nbs.compute_nbs(X, Y, options.thresh, K, 'left',
+                                                  n_jobs = options.n_jobs, random_state = 0,
+                                                  timing = timing)
+            else:
+                tmpdir = tempfile.mkdtemp(prefix = 'nbsbench')
+                D, ij = synthetic_memmap(os.path.join(tmpdir, 'edges.dat'), N, nx, ny,
+                                         options.effect, options.size, N)
+                t0 = time.time()
+                PVAL, COMP, NULL = nbs.compute_nbs_sparse(D, nx, N, options.thresh, K, 'left',
+                                                          n_jobs = options.n_jobs, random_state = 0,
+                                                          chunk_size = options.chunk_size,
+                                                          timing = timing)
+            found = np.sum(PVAL < 0.05)
+        runtime = time.time() - t0
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    row = dict(case = name, engine = engine, N = N, subjects = nx + ny, K = K,
+               runtime = runtime, peak_mb = peak_mb(resource.RUSAGE_SELF),
+               workers_peak_mb = peak_mb(resource.RUSAGE_CHILDREN),
+               perms_per_second = timing['perms_per_second'], found = found, error = '')
+    for stage in STAGES:
+        row[stage] = timing[stage]
+    return row
+
+def peak_mb(who):
+    """ Peak resident memory of this process or of its largest terminated child """
+    # ru_maxrss is in kilobytes on Linux and in bytes on Mac OS X
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 1024. ** (2 if sys.platform == 'darwin' else 1)
+
+def error_row(case, options, error):
+    """ The row of a case that failed """
+    name, N = case
+    row = dict.fromkeys(COLUMNS, np.nan)
+    row.update( case = name, engine = options.engine, N = N,
+                subjects = 2 * options.subjects, K = options.perms, found = -1,
+                error = error.replace(',', ';') )
+    return row
+
+def _case_process(case, options, queue):
+    # keep the messages of compute_nbs out of the results table
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        row = run_case(case, options)
+    except BaseException, e:
+        traceback.print_exc()
+        row = error_row(case, options, '%s: %s' % (e.__class__.__name__, e))
+    queue.put(row)
+
+def run_isolated(case, options):
+    """ Run a case in a fresh process to measure its own peak memory """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target = _case_process, args = (case, options, queue))
+    p.start()
+    row = None
+    while row is None:
+        try:
+            row = queue.get(timeout = 1)
+        except Empty:
+            if p.is_alive():
+                continue
+            # the row may still be on its way from an exited process
+            try:
+                row = queue.get(timeout = 1)
+            except Empty:
+                # e.g. killed by the system when out of memory
+                row = error_row(case, options, 'process exited with code %s' % p.exitcode)
+    p.join()
+    return row
+
+def format_row(row):
+    if row['error']:
+        return "%-10s %-7s %6d  failed: %s" % (row['case'], row['engine'], row['N'],
+                                               row['error'])
+    return "%-10s %-7s %6d %8d %6d %9.2f %9.1f %9.1f %9.2f " % \
+        tuple( row[c] for c in COLUMNS[:9] ) + \
+        " ".join( "%10.2f" % row[s] for s in STAGES ) + " %6d" % row['found']
+
+if __name__ == '__main__':
+
+    parser = OptionParser(usage = "python benchmark.py [options]")
+    parser.add_option("--nodes", default = "84,500,1000,5000",
+                      help = "node counts of the synthetic cohorts [%default]")
+    parser.add_option("--subjects", type = "int", default = 12,
+                      help = "members of each synthetic population [%default]")
+    parser.add_option("--perms", type = "int", default = 50,
+                      help = "number of permutations K [%default]")
+    parser.add_option("--thresh", type = "float", default = 4.5,
+                      help = "t-statistic threshold [%default]")
+    parser.add_option("--effect", type = "float", default = 3.,
+                      help = "mean difference on the planted component [%default]")
+    parser.add_option("--size", type = "int", default = 20,
+                      help = "number of nodes of the planted component [%default]")
+    parser.add_option("--engine", default = "auto", choices = ["auto", "dense", "sparse"],
+                      help = "compute_nbs (dense), compute_nbs_sparse (sparse) or "
+                             "dense up to --dense-max nodes (auto) [%default]")
+    parser.add_option("--dense-max", type = "int", default = 1000,
+                      help = "largest N run with the dense engine in auto mode [%default]")
+    parser.add_option("--chunk-size", type = "int", default = 100000,
+                      help = "edges per chunk of the sparse engine [%default]")
+    parser.add_option("--n-jobs", type = "int", default = 1,
+                      help = "worker processes of the permutations [%default]")
+    parser.add_option("--no-example", action = "store_true", default = False,
+                      help = "skip the X.mat / Y.mat example data")
+    parser.add_option("--output", default = None,
+                      help = "write the results as CSV to this file")
+    (options, args) = parser.parse_args()
+
+    cases = []
+    if not options.no_example:
+        cases.append( ('example', 0) )
+    for N in options.nodes.split(','):
+        if N.strip():
+            cases.append( ('synthetic', int(N)) )
+
+    print "%-10s %-7s %6s %8s %6s %9s %9s %9s %9s " % COLUMNS[:9] + \
+        " ".join( "%10s" % s for s in STAGES ) + " %6s" % 'found'
+    rows = []
+    for case in cases:
+        row = run_isolated(case, options)
+        print format_row(row)
+        sys.stdout.flush()
+        rows.append(row)
+
+    if options.output is not None:
+        f = open(options.output, 'w')
+        f.write( ",".join(COLUMNS) + "\n" )
+        for row in rows:
+            f.write( ",".join( str(row[c]) for c in COLUMNS ) + "\n" )
+        f.close()
@@ -2,6 +2,7 @@
 
 import numpy as np
 import cfflib as cf
+from cviewer.plugins.cff2.packed_fibers import PackedFibers
 
 # load data
 a=cf.load('DATAALE/control01_tp1_run3.cff_FILES/meta.cml')
@@ -30,58 +31,41 @@ gfavol.load()
 # short cut references
 sd=segvol.data.get_data()
 voxdim=fibarr.data[1]['voxel_size']
-fib=fibarr.get_fibers_as_numpy()
+# all fiber points in one array
+fib=PackedFibers.from_fibers(fibarr.get_fibers_as_numpy())
+
+def inner_labels(fib, sd, fromid = 0, toid = 10):
+    """ Labels of the points of the fibers, the fiber of each point,
+    and whether it lies between the first and last point of its fiber """
+    sub = fib[fromid:toid+1]
+    # if voxdim is 1,1,1, we do not have to divide
+    # convert mm to vox
+    idx = sub.points.astype('int32')
+    # retrieve labels along the fibers
+    fiblabels = sd[idx[:,0],idx[:,1],idx[:,2]]
+    inner = np.ones(len(idx), dtype = bool)
+    nonempty = sub.lengths > 0
+    inner[sub.offsets[:-1][nonempty]] = False
+    inner[sub.offsets[1:][nonempty] - 1] = False
+    return fiblabels, sub.fiber_index(), inner, len(sub)
 
 def print_fiblabels(fib, sd, fromid = 0, toid = 10):
-    # loop over fibers
-    ret = []
-    for i in xrange(fromid,toid+1):
-        #print "Path for fiber ", i
-        # if voxdim is 1,1,1, we do not have to divide
-        # convert mm to vox
-        idx = fib[i].astype('int32')
-        # retrieve labels along the fiber
-        fiblabels = sd[idx[:,0],idx[:,1],idx[:,2]]
-#        print "Start: ", fiblabels[0]
-#        print "End: ", fiblabels[-1]
-#        print "Max inbetween: ###############", fiblabels[1:-1].max()
-#        print "----"
-        # number of nonzero elements
-        #print "Max inbetween: ###############", fiblabels[1:-1]
-        ret.append(len(np.where( fiblabels[1:-1] != 0.0 )[0]))
-    return ret
+    fiblabels, fiber, inner, n = inner_labels(fib, sd, fromid, toid)
+    # number of nonzero elements between the endpoints of each fiber
+    valid = inner & (fiblabels != 0.0)
+    return np.bincount(fiber[valid], minlength = n).tolist()
 
 
 def most_select_rois(fib, sd, fromid = 0, toid = 10):
-    ret = []
-    cnt = 0
-    for i in xrange(fromid,toid+1):
-#        print "Path for fiber ", i
-        # if voxdim is 1,1,1, we do not have to divide
-        # convert mm to vox
-        idx = fib[i].astype('int32')
-        # retrieve labels along the fiber
-        fiblabels = sd[idx[:,0],idx[:,1],idx[:,2]]
-#        print "Start: ", fiblabels[0]
-#        print "End: ", fiblabels[-1]
-#        print "Max inbetween: ###############", fiblabels[1:-1]
-#        print "----"
-        # number of nonzero elements
-        #print "Max inbetween: ###############", fiblabels[1:-1]
-        fibinbetween = fiblabels[1:-1]
-        validx = np.where( fibinbetween != 0.0 )[0]
-        #print validx
-        if len(validx) == 0:
-            cnt += 1
-        else:
-            #print fibinbetween[validx]
-            ret = ret + fibinbetween[validx].tolist()
+    fiblabels, fiber, inner, n = inner_labels(fib, sd, fromid, toid)
+    valid = inner & (fiblabels != 0.0)
+    cnt = np.sum( np.bincount(fiber[valid], minlength = n) == 0 )
     print "We counted clean fibers", cnt
-    return ret
+    return fiblabels[valid].tolist()
     
-e=most_select_rois(fib,sd, fromid = 0, toid = fib.shape[0]-1)
+e=most_select_rois(fib,sd, fromid = 0, toid = len(fib)-1)
 
-#inf=print_fiblabels(fib, sd, fromid = 0, toid = fib.shape[0]-1)
+#inf=print_fiblabels(fib, sd, fromid = 0, toid = len(fib)-1)
 #plot(inf)
 
 